@@ -0,0 +1,199 @@
+# Measures how long generating a fixed seed takes for every preset in presets_default.json
+# and some of the test settings, with no ROM output, so no base ROM is needed.
+# Each seed is generated in a fresh process with the phase profile of Main
+# (see Profiler.py), and the results can be compared against those of an earlier run:
+#
+#   python3 Benchmark.py --output before.json
+#   (make your changes)
+#   python3 Benchmark.py --baseline before.json
+
+import argparse
+import json
+import multiprocessing
+import logging
+import os
+import platform
+import re
+import sys
+import tempfile
+
+from Main import main
+import Profiler
+from Settings import Settings
+from Utils import data_path, default_output_path
+from version import __version__
+
+test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tests')
+default_test_files = ['multiworld.sav', 'entrance.sav', 'glitched-standard.sav', 'ludicrous.sav']
+
+
+# Returns the settings of each case by name: the presets under their own name,
+# and the test settings under their file name.
+def get_cases(test_files):
+    with open(data_path('presets_default.json'), encoding='utf-8') as f:
+        cases = json.load(f)
+    for filename in test_files:
+        with open(os.path.join(test_dir, filename), encoding='utf-8') as f:
+            cases[filename] = json.load(f)
+    return cases
+
+
+# Runs in a worker process of its own. Returns the profile Main wrote for the seed,
+# or the error that stopped it from being generated.
+def generate_case(name, settings_dict, seed, output_dir, trace_memory):
+    logging.basicConfig(format='%(message)s', level=logging.ERROR)
+    settings_dict = dict(settings_dict)
+    settings_dict.update({
+        'create_patch_file': False,
+        'create_compressed_rom': False,
+        'create_wad_file': False,
+        'create_uncompressed_rom': False,
+        'patch_without_output': False,
+        'create_spoiler': True,
+        'count': 1,
+        'seed': seed,
+        'output_file': os.path.join(output_dir, re.sub(r'[^a-zA-Z0-9_-]+', '_', name)),
+        'profile_generation': True,
+        'profile_memory': trace_memory,
+        'profile_rules': False,
+    })
+    settings = Settings(settings_dict, strict=False)
+    try:
+        main(settings)
+    except Exception as e:
+        return {'error': '%s: %s' % (type(e).__name__, e)}
+    with open('%s_Profile.json' % settings.output_file, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Adds up the phases of a profile by their path without the attempts,
+# so retried phases count the time of every attempt.
+def summarize_profile(profile):
+    phases = {}
+    attempts = 0
+    for phase in profile['phases']:
+        path = phase['phase']
+        if re.fullmatch(r'total/attempt \d+', path):
+            attempts += 1
+            continue
+        path = re.sub(r'/attempt \d+', '', path)
+        path = path[len('total/'):] if path.startswith('total/') else path
+        summary = phases.setdefault(path, {'wall': 0.0, 'cpu': 0.0})
+        summary['wall'] = round(summary['wall'] + phase['wall'], 4)
+        summary['cpu'] = round(summary['cpu'] + phase['cpu'], 4)
+        if 'peak_memory' in phase:
+            summary['peak_memory'] = max(summary.get('peak_memory', 0), phase['peak_memory'])
+    return {'attempts': attempts, 'phases': phases, 'counters': profile['counters']}
+
+
+# Generates each case repeat times, keeping the fastest time of each phase,
+# and once more tracing memory if asked to, for the peak memory of each phase.
+def run_benchmark(cases, seed, repeat, trace_memory):
+    results = {}
+    runs = [False] * repeat + ([True] if trace_memory else [])
+    with tempfile.TemporaryDirectory() as output_dir:
+        # One seed at a time, each in a new process, so they don't share caches or CPUs
+        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+            for name, settings_dict in cases.items():
+                result = None
+                for tracing in runs:
+                    profile = pool.apply(generate_case, (name, settings_dict, seed, output_dir, tracing))
+                    if 'error' in profile:
+                        result = profile
+                        break
+                    summary = summarize_profile(profile)
+                    if result is None:
+                        result = summary
+                        continue
+                    for path, phase in summary['phases'].items():
+                        best = result['phases'].setdefault(path, {})
+                        if tracing:
+                            best['peak_memory'] = phase['peak_memory']
+                        else:
+                            best['wall'] = min(best.get('wall', phase['wall']), phase['wall'])
+                            best['cpu'] = min(best.get('cpu', phase['cpu']), phase['cpu'])
+                results[name] = result
+                if 'error' in result:
+                    print('%-40s failed: %s' % (name, result['error']))
+                else:
+                    print('%-40s %8.2fs' % (name, result['phases']['total'].get('wall', 0.0)))
+    return results
+
+
+# Prints how the time of each phase changed since the baseline and returns how
+# many got slower by more than the threshold (a fraction of the baseline time),
+# ignoring those that changed by less than min_seconds.
+def compare_results(results, baseline, threshold, min_seconds):
+    regressions = 0
+    for name, result in results['cases'].items():
+        old_result = baseline['cases'].get(name)
+        if old_result is None:
+            print('%s: not in the baseline' % name)
+            continue
+        if 'error' in result or 'error' in old_result:
+            print('%s: %s -> %s' % (name, old_result.get('error', 'ok'), result.get('error', 'ok')))
+            continue
+        print(name)
+        for path, phase in result['phases'].items():
+            old_phase = old_result['phases'].get(path)
+            if old_phase is None or 'wall' not in phase or 'wall' not in old_phase:
+                continue
+            old_time, new_time = old_phase['wall'], phase['wall']
+            slower = new_time - old_time > max(min_seconds, old_time * threshold)
+            if slower:
+                regressions += 1
+            ratio = '%7.1f%%' % ((new_time / old_time - 1) * 100) if old_time else '        '
+            print('  %s %-60s %8.3fs -> %8.3fs %s' % ('!' if slower else ' ', path, old_time, new_time, ratio))
+    return regressions
+
+
+def run_benchmark_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', nargs='+', help='Only run the presets or test files with these names')
+    parser.add_argument('--test_files', nargs='+', default=default_test_files, help='Test settings files to run besides the presets')
+    parser.add_argument('--seed', default='BENCHMARK', help='Seed to generate for every case')
+    parser.add_argument('--world_count', type=int, help='Generate every case with this many worlds instead of its own world count')
+    parser.add_argument('--repeat', type=int, default=1, help='Generate each seed this many times and keep the fastest')
+    parser.add_argument('--memory', help='Generate each seed once more tracing memory, for the peak memory of each phase', action='store_true')
+    parser.add_argument('--output', help='Results file to write, Output/Benchmark.json by default')
+    parser.add_argument('--baseline', help='Results file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Fraction of its baseline time a phase can get slower by before it counts as a regression')
+    parser.add_argument('--min_seconds', type=float, default=0.05, help='Changes smaller than this many seconds never count as a regression')
+    args = parser.parse_args()
+    if args.memory and not Profiler.can_trace_memory:
+        parser.error('--memory needs Python 3.9 or newer')
+
+    cases = get_cases(args.test_files)
+    if args.cases:
+        unknown = set(args.cases) - set(cases)
+        if unknown:
+            parser.error('Unknown cases: %s' % ', '.join(sorted(unknown)))
+        cases = {name: cases[name] for name in args.cases}
+    if args.world_count:
+        cases = {name: dict(settings_dict, world_count=args.world_count) for name, settings_dict in cases.items()}
+
+    results = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'world_count': args.world_count,
+        'repeat': args.repeat,
+        'cases': run_benchmark(cases, args.seed, max(args.repeat, 1), args.memory),
+    }
+    output_path = args.output or os.path.join(default_output_path(''), 'Benchmark.json')
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print('Results written to %s' % output_path)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print('%d phases got slower than the baseline.' % regressions, file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_benchmark_cli()
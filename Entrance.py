@@ -58,10 +58,12 @@ class Entrance(object):
     def connect(self, region):
         self.connected_region = region
         region.entrances.append(self)
+        self.world.graph_version += 1
 
 
     def disconnect(self):
         self.connected_region.entrances.remove(self)
+        self.world.graph_version += 1
         previously_connected = self.connected_region
         self.connected_region = None
         return previously_connected
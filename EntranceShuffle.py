@@ -1,8 +1,10 @@
 import random
 import logging
+import os
+import signal
 from itertools import chain
 from Fill import ShuffleError
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from Search import Search
 from Region import TimeOfDay
 from Rules import set_entrances_based_rules
@@ -28,6 +30,8 @@ def set_all_entrances_data(world):
             forward_entrance.bind_two_way(return_entrance)
             if type == 'Grotto':
                 return_entrance.data['index'] = 0x7FFF
+    # Hint areas are found by entrance type
+    world.graph_version += 1
 
 
 def assume_entrance_pool(entrance_pool):
@@ -440,6 +444,7 @@ def shuffle_random_entrances(worlds):
     non_drop_locations = [location for world in worlds for location in world.get_locations() if location.type not in ('Drop', 'Event')]
     max_search.visit_locations(non_drop_locations)
     locations_to_ensure_reachable = list(filter(max_search.visited, non_drop_locations))
+    searches = ValidationSearches(worlds)
 
     # Shuffle all entrances within their own worlds
     for world in worlds:
@@ -589,7 +594,7 @@ def shuffle_random_entrances(worlds):
                         break
 
         # Place priority entrances
-        placed_one_way_entrances = shuffle_one_way_priority_entrances(worlds, world, one_way_priorities, one_way_entrance_pools, one_way_target_entrance_pools, locations_to_ensure_reachable, complete_itempool, retry_count=2)
+        placed_one_way_entrances = shuffle_one_way_priority_entrances(worlds, world, one_way_priorities, one_way_entrance_pools, one_way_target_entrance_pools, locations_to_ensure_reachable, complete_itempool, retry_count=2, searches=searches)
 
         # Delete all targets that we just placed from one way target pools so multiple one way entrances don't use the same target
         replaced_entrances = [entrance.replaces for entrance in chain.from_iterable(one_way_entrance_pools.values())]
@@ -600,7 +605,7 @@ def shuffle_random_entrances(worlds):
 
         # Shuffle all entrances among the pools to shuffle
         for pool_type, entrance_pool in one_way_entrance_pools.items():
-            placed_one_way_entrances += shuffle_entrance_pool(world, worlds, entrance_pool, one_way_target_entrance_pools[pool_type], locations_to_ensure_reachable, check_all=True, placed_one_way_entrances=placed_one_way_entrances)
+            placed_one_way_entrances += shuffle_entrance_pool(world, worlds, entrance_pool, one_way_target_entrance_pools[pool_type], locations_to_ensure_reachable, check_all=True, placed_one_way_entrances=placed_one_way_entrances, searches=searches)
             # Delete all targets that we just placed from other one way target pools so multiple one way entrances don't use the same target
             replaced_entrances = [entrance.replaces for entrance in entrance_pool]
             for remaining_target in chain.from_iterable(one_way_target_entrance_pools.values()):
@@ -611,11 +616,11 @@ def shuffle_random_entrances(worlds):
                 delete_target_entrance(unused_target)
 
         for pool_type, entrance_pool in entrance_pools.items():
-            shuffle_entrance_pool(world, worlds, entrance_pool, target_entrance_pools[pool_type], locations_to_ensure_reachable, placed_one_way_entrances=placed_one_way_entrances)
+            shuffle_entrance_pool(world, worlds, entrance_pool, target_entrance_pools[pool_type], locations_to_ensure_reachable, placed_one_way_entrances=placed_one_way_entrances, searches=searches)
 
 
     # Multiple checks after shuffling entrances to make sure everything went fine
-    max_search = Search.max_explore([world.state for world in worlds], complete_itempool)
+    max_search = searches.max_explore(complete_itempool)
 
     # Check that all shuffled entrances are properly connected to a region
     for world in worlds:
@@ -636,19 +641,19 @@ def shuffle_random_entrances(worlds):
     # Validate the worlds one last time to ensure all special conditions are still valid
     for world in worlds:
         try:
-            validate_world(world, worlds, None, locations_to_ensure_reachable, complete_itempool, placed_one_way_entrances=placed_one_way_entrances)
+            validate_world(world, worlds, None, locations_to_ensure_reachable, complete_itempool, placed_one_way_entrances=placed_one_way_entrances, searches=searches)
         except EntranceShuffleError as error:
             raise EntranceShuffleError('Worlds are not valid after shuffling entrances, Reason: %s' % error)
 
 
-def shuffle_one_way_priority_entrances(worlds, world, one_way_priorities, one_way_entrance_pools, one_way_target_entrance_pools, locations_to_ensure_reachable, complete_itempool, retry_count=2):
+def shuffle_one_way_priority_entrances(worlds, world, one_way_priorities, one_way_entrance_pools, one_way_target_entrance_pools, locations_to_ensure_reachable, complete_itempool, retry_count=2, searches=None):
     while retry_count:
         retry_count -= 1
         rollbacks = []
 
         try:
             for key, (regions, types) in one_way_priorities.items():
-                place_one_way_priority_entrance(worlds, world, key, regions, types, rollbacks, locations_to_ensure_reachable, complete_itempool, one_way_entrance_pools, one_way_target_entrance_pools)
+                place_one_way_priority_entrance(worlds, world, key, regions, types, rollbacks, locations_to_ensure_reachable, complete_itempool, one_way_entrance_pools, one_way_target_entrance_pools, searches=searches)
 
             # If all entrances could be connected without issues, log connections and continue
             for entrance, target in rollbacks:
@@ -668,7 +673,7 @@ def shuffle_one_way_priority_entrances(worlds, world, one_way_priorities, one_wa
     raise EntranceShuffleError('Entrance placement attempt count exceeded for world %d. Retry a few times or reach out to Support on Discord for help.' % world.id)
 
 # Shuffle all entrances within a provided pool
-def shuffle_entrance_pool(world, worlds, entrance_pool, target_entrances, locations_to_ensure_reachable, check_all=False, retry_count=20, placed_one_way_entrances=()):
+def shuffle_entrance_pool(world, worlds, entrance_pool, target_entrances, locations_to_ensure_reachable, check_all=False, retry_count=20, placed_one_way_entrances=(), searches=None):
 
     # Split entrances between those that have requirements (restrictive) and those that do not (soft). These are primarily age or time of day requirements.
     restrictive_entrances, soft_entrances = split_entrances_by_requirements(worlds, entrance_pool, target_entrances)
@@ -679,17 +684,17 @@ def shuffle_entrance_pool(world, worlds, entrance_pool, target_entrances, locati
 
         try:
             # Shuffle restrictive entrances first while more regions are available in order to heavily reduce the chances of the placement failing.
-            shuffle_entrances(worlds, restrictive_entrances, target_entrances, rollbacks, locations_to_ensure_reachable, placed_one_way_entrances=placed_one_way_entrances)
+            shuffle_entrances(worlds, restrictive_entrances, target_entrances, rollbacks, locations_to_ensure_reachable, placed_one_way_entrances=placed_one_way_entrances, searches=searches)
 
             # Shuffle the rest of the entrances, we don't have to check for beatability/reachability of locations when placing those, unless specified otherwise
             if check_all:
-                shuffle_entrances(worlds, soft_entrances, target_entrances, rollbacks, locations_to_ensure_reachable, placed_one_way_entrances=placed_one_way_entrances)
+                shuffle_entrances(worlds, soft_entrances, target_entrances, rollbacks, locations_to_ensure_reachable, placed_one_way_entrances=placed_one_way_entrances, searches=searches)
             else:
-                shuffle_entrances(worlds, soft_entrances, target_entrances, rollbacks, placed_one_way_entrances=placed_one_way_entrances)
+                shuffle_entrances(worlds, soft_entrances, target_entrances, rollbacks, placed_one_way_entrances=placed_one_way_entrances, searches=searches)
 
             # Fully validate the resulting world to ensure everything is still fine after shuffling this pool
             complete_itempool = [item for world in worlds for item in world.get_itempool_with_dungeon_items()]
-            validate_world(world, worlds, None, locations_to_ensure_reachable, complete_itempool, placed_one_way_entrances=placed_one_way_entrances)
+            validate_world(world, worlds, None, locations_to_ensure_reachable, complete_itempool, placed_one_way_entrances=placed_one_way_entrances, searches=searches)
 
             # If all entrances could be connected without issues, log connections and continue
             for entrance, target in rollbacks:
@@ -745,11 +750,13 @@ def split_entrances_by_requirements(worlds, entrances_to_split, assumed_entrance
     return restrictive_entrances, soft_entrances
 
 
-def replace_entrance(worlds, entrance, target, rollbacks, locations_to_ensure_reachable, itempool, placed_one_way_entrances=()):
+# Targets from EntranceCompatibility.compatible_targets aren't checked again if it's given
+def replace_entrance(worlds, entrance, target, rollbacks, locations_to_ensure_reachable, itempool, placed_one_way_entrances=(), searches=None, compatibility=None):
     try:
-        check_entrances_compatibility(entrance, target, rollbacks, placed_one_way_entrances)
+        if compatibility is None:
+            check_entrances_compatibility(entrance, target, rollbacks, placed_one_way_entrances)
         change_connections(entrance, target)
-        validate_world(entrance.world, worlds, entrance, locations_to_ensure_reachable, itempool, placed_one_way_entrances=placed_one_way_entrances)
+        validate_world(entrance.world, worlds, entrance, locations_to_ensure_reachable, itempool, placed_one_way_entrances=placed_one_way_entrances, searches=searches)
         rollbacks.append((entrance, target))
         return True
     except EntranceShuffleError as error:
@@ -764,7 +771,7 @@ def replace_entrance(worlds, entrance, target, rollbacks, locations_to_ensure_re
 # Connect one random entrance from entrance pools to one random target in the respective target pool.
 # Entrance chosen will have one of the allowed types.
 # Target chosen will lead to one of the allowed regions.
-def place_one_way_priority_entrance(worlds, world, priority_name, allowed_regions, allowed_types, rollbacks, locations_to_ensure_reachable, complete_itempool, one_way_entrance_pools, one_way_target_entrance_pools):
+def place_one_way_priority_entrance(worlds, world, priority_name, allowed_regions, allowed_types, rollbacks, locations_to_ensure_reachable, complete_itempool, one_way_entrance_pools, one_way_target_entrance_pools, searches=None):
     # Combine the entrances for allowed types in one list.
     # Shuffle this list.
     # Pick the first one not already set, not adult spawn, that has a valid target entrance.
@@ -785,7 +792,7 @@ def place_one_way_priority_entrance(worlds, world, priority_name, allowed_region
                 continue
         for target in one_way_target_entrance_pools[entrance.type]:
             if target.connected_region and target.connected_region.name in allowed_regions:
-                if replace_entrance(worlds, entrance, target, rollbacks, locations_to_ensure_reachable, complete_itempool):
+                if replace_entrance(worlds, entrance, target, rollbacks, locations_to_ensure_reachable, complete_itempool, searches=searches):
                     logging.getLogger('').debug(f'Priority placement for {priority_name}: placing {entrance} as {target}')
                     return
     raise EntranceShuffleError(f'Unable to place priority one-way entrance for {priority_name} [World {world.id}].')
@@ -793,10 +800,12 @@ def place_one_way_priority_entrance(worlds, world, priority_name, allowed_region
 
 # Shuffle entrances by placing them instead of entrances in the provided target entrances list
 # While shuffling entrances, the algorithm will ensure worlds are still valid based on multiple criterias
-def shuffle_entrances(worlds, entrances, target_entrances, rollbacks, locations_to_ensure_reachable=(), placed_one_way_entrances=()):
+def shuffle_entrances(worlds, entrances, target_entrances, rollbacks, locations_to_ensure_reachable=(), placed_one_way_entrances=(), searches=None):
 
     # Retrieve all items in the itempool, all worlds included
     complete_itempool = [item for world in worlds for item in world.get_itempool_with_dungeon_items()]
+    compatibility = EntranceCompatibility(target_entrances, (*rollbacks, *placed_one_way_entrances))
+    workers = speculation_workers(worlds)
 
     random.shuffle(entrances)
 
@@ -806,17 +815,78 @@ def shuffle_entrances(worlds, entrances, target_entrances, rollbacks, locations_
             continue
         random.shuffle(target_entrances)
 
-        for target in target_entrances:
-            if target.connected_region == None:
+        # Only the targets the entrance is compatible with are tried
+        targets = compatibility.compatible_targets(entrance, target_entrances)
+        first_valid = 0
+        for index, target in enumerate(targets):
+            if index < first_valid:
+                # Known to fail, so only change the connections back and forth like trying it would,
+                # leaving the regions' entrances in the same order
+                change_connections(entrance, target)
+                restore_connections(entrance, target)
                 continue
 
-            if replace_entrance(worlds, entrance, target, rollbacks, locations_to_ensure_reachable, complete_itempool, placed_one_way_entrances=placed_one_way_entrances):
+            if replace_entrance(worlds, entrance, target, rollbacks, locations_to_ensure_reachable, complete_itempool, placed_one_way_entrances=placed_one_way_entrances, searches=searches, compatibility=compatibility):
+                compatibility.place(entrance)
                 break
 
+            # The first target usually works, so the others are only tried several at once once it didn't
+            if index == 0 and workers > 1 and len(targets) > 2:
+                first_valid = 1 + speculate_targets(workers, worlds, entrance, targets[1:], locations_to_ensure_reachable, complete_itempool, placed_one_way_entrances, searches, compatibility)
+
         if entrance.connected_region == None:
             raise EntranceShuffleError('No more valid entrances to replace with %s in world %d' % (entrance, entrance.world.id))
 
 
+# How many targets speculate_targets can try at once, if more than one.
+# The workers are forked from this process, so there are none where that isn't possible.
+def speculation_workers(worlds):
+    workers = worlds[0].settings.entrance_shuffle_workers
+    if workers < 2 or not hasattr(os, 'fork'):
+        return 0
+    return workers
+
+
+# Tries the targets for the entrance in processes forked from this one, several at once,
+# and returns the index of the first it can replace, or the number of targets if there is none.
+# Each worker tries its target on the graph as trying the ones before it would have left it,
+# so this finds the same target as trying them one at a time here would. If a worker fails
+# to tell, its index is returned so its target is tried here again.
+def speculate_targets(workers, worlds, entrance, targets, locations_to_ensure_reachable, itempool, placed_one_way_entrances, searches, compatibility):
+    for start in range(0, len(targets), workers):
+        children = []
+        try:
+            for index in range(start, min(start + workers, len(targets))):
+                read_end, write_end = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        # The worker shares the parent's log files but exits without flushing,
+                        # so it doesn't log at all rather than interleave with the parent
+                        logging.disable(logging.CRITICAL)
+                        os.close(read_end)
+                        # Trying the targets before this one changed the connections back and forth
+                        for target in targets[:index]:
+                            change_connections(entrance, target)
+                            restore_connections(entrance, target)
+                        valid = replace_entrance(worlds, entrance, targets[index], [], locations_to_ensure_reachable, itempool, placed_one_way_entrances, searches=searches, compatibility=compatibility)
+                        os.write(write_end, b'1' if valid else b'0')
+                    finally:
+                        os._exit(0)
+                os.close(write_end)
+                children.append((index, pid, read_end))
+
+            for index, pid, read_end in children:
+                if os.read(read_end, 1) != b'0':
+                    return index
+        finally:
+            for index, pid, read_end in children:
+                os.close(read_end)
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+    return len(targets)
+
+
 # Check and validate that an entrance is compatible to replace a specific target
 def check_entrances_compatibility(entrance, target, rollbacks=(), placed_one_way_entrances=()):
     # An entrance shouldn't be connected to its own scene, so we fail in that situation
@@ -840,8 +910,122 @@ def check_entrances_compatibility(entrance, target, rollbacks=(), placed_one_way
                     pass
 
 
+# The targets of a pool that each entrance can replace according to check_entrances_compatibility,
+# so the others are left out before trying any. The targets are grouped by the scene they lead to
+# once for the pool, and the one-way entrances placed so far are kept track of by type.
+class EntranceCompatibility(object):
+
+    def __init__(self, target_entrances, placed_entrances=()):
+        self.targets_by_scene = defaultdict(set)
+        for target in target_entrances:
+            if target.connected_region and target.connected_region.get_scene():
+                self.targets_by_scene[target.connected_region.get_scene()].add(target)
+        # One-way entrances placed so far, by type
+        self.placed_one_way = defaultdict(list)
+        for entrance, _ in placed_entrances:
+            self.place(entrance)
+
+
+    def place(self, entrance):
+        if entrance.type in ('OverworldOneWay', 'OwlDrop', 'Spawn', 'WarpSong'):
+            self.placed_one_way[entrance.type].append(entrance)
+
+
+    # Returns the targets still connected that the entrance can replace, in order
+    def compatible_targets(self, entrance, target_entrances):
+        # An entrance shouldn't be connected to its own scene
+        same_scene = self.targets_by_scene.get(entrance.parent_region.get_scene(), ())
+        # One way entrances shouldn't lead to the same hint area as other one way entrances of their type.
+        # Placing other entrances can connect those to a hint area, so they are looked up every time.
+        used_hint_areas = set()
+        for placed_entrance in self.placed_one_way.get(entrance.type, ()):
+            try:
+                used_hint_areas.add(HintArea.at(placed_entrance.connected_region))
+            except HintAreaNotFound:
+                pass
+        compatible = []
+        for target in target_entrances:
+            if target.connected_region is None or target in same_scene:
+                continue
+            if used_hint_areas:
+                try:
+                    if HintArea.at(target.connected_region) in used_hint_areas:
+                        continue
+                except HintAreaNotFound:
+                    pass
+            compatible.append(target)
+        return compatible
+
+
+# The searches made to validate the worlds while shuffling their entrances. Each placement
+# only changes a few connections, so each search takes over what the last one of its kind
+# reached through exits that are still connected the same way (see Search.replay)
+# instead of exploring all the worlds again.
+class ValidationSearches(object):
+
+    def __init__(self, worlds):
+        self.worlds = worlds
+        # Kind of search -> the last one made, and the connections of each world then
+        self.last = {}
+        # The connections of each world as of its last graph version we looked at
+        self.connections = {}
+
+
+    # Returns the region each exit of the world leads to, by exit, and the graph version
+    # of the world it was taken at
+    def get_connections(self, world):
+        connections = self.connections.get(world.id)
+        if connections is None or connections[0] != world.graph_version:
+            connections = self.connections[world.id] = (world.graph_version, {
+                exit: exit.connected_region for region in world.regions for exit in region.exits})
+        return connections
+
+
+    # Returns a search of the given kind from state_list with the items collected,
+    # after explore(search) finished exploring it
+    def search(self, kind, state_list, items, explore):
+        search = Search(state_list, explore=False)
+        search.collect_all(items)
+        connections = [self.get_connections(world) for world in self.worlds]
+        if kind in self.last:
+            last_search, last_connections = self.last[kind]
+            # The exits connected elsewhere since, with where they led then
+            changed_exits = {}
+            for (version, exits), (last_version, last_exits) in zip(connections, last_connections):
+                if version == last_version:
+                    continue
+                for exit, region in last_exits.items():
+                    if exits.get(exit) is not region:
+                        changed_exits[exit] = region
+                for exit in exits:
+                    if exit not in last_exits:
+                        changed_exits[exit] = None
+            search.replay(last_search, changed_exits)
+        else:
+            search.start_trail()
+        explore(search)
+        self.last[kind] = (search, connections)
+        return search
+
+
+    def max_explore(self, itempool):
+        return self.search('max', [world.state for world in self.worlds], itempool, Search.collect_locations)
+
+
+    def no_items(self):
+        return self.search('no items', [State(world) for world in self.worlds], (), Search.next_sphere)
+
+
+    def time_travel(self):
+        return self.search('time travel', [world.state for world in self.worlds],
+                           [ItemFactory('Time Travel', world=world) for world in self.worlds], Search.next_sphere)
+
+
 # Validate the provided worlds' structures, raising an error if it's not valid based on our criterias
-def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable, itempool, placed_one_way_entrances=()):
+# The searches are taken over from the last validation if given
+def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable, itempool, placed_one_way_entrances=(), searches=None):
+    if searches is None:
+        searches = ValidationSearches(worlds)
 
     # For various reasons, we don't want the player to end up through certain entrances as the wrong age
     # This means we need to hard check that none of the relevant entrances are ever reachable as that age
@@ -863,8 +1047,9 @@ def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable
             elif entrance.name in ADULT_FORBIDDEN and not entrance_unreachable_as(entrance, 'adult', already_checked=[entrance.reverse]):
                 raise EntranceShuffleError('%s is potentially accessible as adult' % entrance.name)
 
+    time_travel_search = None
     if locations_to_ensure_reachable:
-        max_search = Search.max_explore([w.state for w in worlds], itempool)
+        max_search = searches.max_explore(itempool)
         if world.check_beatable_only:
             if worlds[0].settings.reachable_locations == 'goals':
                 # If this entrance is required for a goal, it must be placed somewhere reachable.
@@ -906,14 +1091,14 @@ def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable
        (entrance_placed == None or entrance_placed.type in ('SpecialInterior', 'Overworld', 'OverworldOneWay', 'Spawn', 'WarpSong', 'OwlDrop')):
         # At least one valid starting region with all basic refills should be reachable without using any items at the beginning of the seed
         # Note this creates new empty states rather than reuse the worlds' states (which already have starting items)
-        no_items_search = Search([State(w) for w in worlds])
+        no_items_search = searches.no_items()
 
         valid_starting_regions = ['Kokiri Forest', 'Kakariko Village']
         if not any(region for region in valid_starting_regions if no_items_search.can_reach(world.get_region(region))):
             raise EntranceShuffleError('Invalid starting area')
 
         # Check that a region where time passes is always reachable as both ages without having collected any items
-        time_travel_search = Search.with_items([w.state for w in worlds], [ItemFactory('Time Travel', world=w) for w in worlds])
+        time_travel_search = searches.time_travel()
 
         if not (any(region for region in time_travel_search.reachable_regions('child') if region.time_passes and region.world == world) and
                 any(region for region in time_travel_search.reachable_regions('adult') if region.time_passes and region.world == world)):
@@ -931,7 +1116,8 @@ def validate_world(world, worlds, entrance_placed, locations_to_ensure_reachable
         # The Big Poe Shop should always be accessible as adult without the need to use any bottles
         # This is important to ensure that players can never lock their only bottles by filling them with Big Poes they can't sell
         # We can use starting items in this check as long as there are no exits requiring the use of a bottle without refills
-        time_travel_search = Search.with_items([w.state for w in worlds], [ItemFactory('Time Travel', world=w) for w in worlds])
+        if time_travel_search is None:
+            time_travel_search = searches.time_travel()
 
         if not time_travel_search.can_reach(world.get_region('Market Guard House'), age='adult'):
             raise EntranceShuffleError('Big Poe Shop access is not guaranteed as adult')
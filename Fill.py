@@ -1,5 +1,6 @@
 import random
 import logging
+from collections import Counter, defaultdict
 from Hints import HintArea
 from State import State
 from Rules import set_shop_rules
@@ -8,6 +9,7 @@ from LocationList import location_groups
 from ItemPool import remove_junk_items
 from Item import ItemFactory, ItemInfo
 from Search import Search
+import Profiler
 
 logger = logging.getLogger('')
 
@@ -124,7 +126,8 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # or not. This shouldn't have much affect on item bias.
     if shop_locations:
         logger.info('Placing shop items.')
-        fill_ownworld_restrictive(window, worlds, search, shop_locations, shopitempool, itempool + songitempool + dungeon_items, "shop")
+        with Profiler.phase('shop items'):
+            fill_ownworld_restrictive(window, worlds, search, shop_locations, shopitempool, itempool + songitempool + dungeon_items, "shop")
     # Update the shop item access rules
     for world in worlds:
         set_shop_rules(world)
@@ -137,7 +140,8 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # placement, but will leave as is for now
     if dungeon_items:
         logger.info('Placing dungeon items.')
-        fill_dungeons_restrictive(window, worlds, search, fill_locations, dungeon_items, itempool + songitempool)
+        with Profiler.phase('dungeon items'):
+            fill_dungeons_restrictive(window, worlds, search, fill_locations, dungeon_items, itempool + songitempool)
         search.collect_locations()
 
 
@@ -145,8 +149,9 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     if worlds[0].settings.empty_dungeons_mode != 'none':
         empty_locations = [location for location in fill_locations \
             if world.empty_dungeons[HintArea.at(location).dungeon_name].empty]
+        empty_location_set = set(empty_locations)
+        fill_locations[:] = [location for location in fill_locations if location not in empty_location_set]
         for location in empty_locations:
-            fill_locations.remove(location)
             location.world.hint_type_overrides['sometimes'].append(location.name)
             location.world.hint_type_overrides['random'].append(location.name)
 
@@ -175,7 +180,8 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # the song locations only.
     if worlds[0].settings.shuffle_song_items != 'any':
         logger.info('Placing song items.')
-        fill_ownworld_restrictive(window, worlds, search, song_locations, songitempool, progitempool, "song")
+        with Profiler.phase('song items'):
+            fill_ownworld_restrictive(window, worlds, search, song_locations, songitempool, progitempool, "song")
         search.collect_locations()
         fill_locations += [location for location in song_locations if location.item is None]
 
@@ -183,14 +189,16 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # placed to ensure there is a spot available for them
     if worlds[0].settings.one_item_per_dungeon:
         logger.info('Placing one major item per dungeon.')
-        fill_dungeon_unique_item(window, worlds, search, fill_locations, progitempool)
+        with Profiler.phase('one major item per dungeon'):
+            fill_dungeon_unique_item(window, worlds, search, fill_locations, progitempool)
         search.collect_locations()
 
     # Place all progression items. This will include keys in keysanity.
     # Items in this group will check for reachability and will be placed
     # such that the game is guaranteed beatable.
     logger.info('Placing progression items.')
-    fill_restrictive(window, worlds, search, fill_locations, progitempool)
+    with Profiler.phase('progression items'):
+        fill_restrictive(window, worlds, search, fill_locations, progitempool)
     search.collect_locations()
 
     # Place all priority items.
@@ -198,13 +206,15 @@ def distribute_items_restrictive(window, worlds, fill_locations=None):
     # placed in the location, not checking reachability. This is important
     # for things like Ice Traps that can't be found at some locations
     logger.info('Placing priority items.')
-    fill_restrictive_fast(window, worlds, fill_locations, prioitempool)
+    with Profiler.phase('priority items'):
+        fill_restrictive_fast(window, worlds, fill_locations, prioitempool)
 
     # Place the rest of the items.
     # No restrictions at all. Places them completely randomly. Since they
     # cannot affect the beatability, we don't need to check them
     logger.info('Placing the rest of the items.')
-    fast_fill(window, fill_locations, restitempool)
+    with Profiler.phase('rest of the items'):
+        fast_fill(window, fill_locations, restitempool)
 
     # Log unplaced item/location warnings
     for item in progitempool + prioitempool + restitempool:
@@ -286,6 +296,7 @@ def fill_dungeon_unique_item(window, worlds, search, fill_locations, itempool):
     base_search.collect_all(minor_items)
     base_search.collect_locations()
     all_dungeon_locations = []
+    open_locations = set(fill_locations)
 
     # iterate of all the dungeons in a random order, placing the item there
     for dungeon in dungeons:
@@ -297,7 +308,7 @@ def fill_dungeon_unique_item(window, worlds, search, fill_locations, itempool):
                     regions.append(region)
             except:
                 pass
-        dungeon_locations = [location for region in regions for location in region.locations if location in fill_locations]
+        dungeon_locations = [location for region in regions for location in region.locations if location in open_locations]
 
         # cache this list to flag afterwards
         all_dungeon_locations.extend(dungeon_locations)
@@ -310,14 +321,16 @@ def fill_dungeon_unique_item(window, worlds, search, fill_locations, itempool):
                 major_items.append(item)
 
         # place 1 item into the dungeon
-        fill_restrictive(window, worlds, base_search, dungeon_locations, major_items, 1)
+        fill_restrictive(window, worlds, base_search, list(dungeon_locations), major_items, 1)
 
-        # update the location and item pool, removing any placed items and filled locations
-        # the fact that you can remove items from a list you're iterating over is python magic
-        for item in itempool:
-            if item.location != None:
-                fill_locations.remove(item.location)
-                itempool.remove(item)
+        # take the filled location out of the ones left for the other dungeons
+        for location in dungeon_locations:
+            if location.item is not None:
+                open_locations.discard(location)
+
+    # update the location and item pool, removing any placed items and filled locations
+    fill_locations[:] = [location for location in fill_locations if location in open_locations]
+    itempool[:] = [item for item in itempool if item.location is None]
 
     # flag locations to not place further major items. it's important we do it on the
     # locations instead of the dungeon because some locations are not in the dungeon
@@ -378,6 +391,103 @@ def fill_ownworld_restrictive(window, worlds, search, locations, ownpool, itempo
 
 
 
+# The locations a fill has left, kept in the list it was given. Any of them can be
+# removed in constant time by moving the last one into its place, and they can be
+# gone through in a random order that is only drawn as far as the fill looks,
+# instead of shuffling all of them for every item placed.
+class LocationPool(object):
+
+    def __init__(self, locations):
+        self.locations = locations
+        self.positions = {location: i for i, location in enumerate(locations)}
+
+
+    def __len__(self):
+        return len(self.locations)
+
+
+    def __iter__(self):
+        return iter(self.locations)
+
+
+    def __contains__(self, location):
+        return location in self.positions
+
+
+    def remove(self, location):
+        i = self.positions.pop(location)
+        last = self.locations.pop()
+        if last is not location:
+            self.locations[i] = last
+            self.positions[last] = i
+
+
+    # Yields every location in a random order, shuffling the list one step per
+    # location yielded. Nothing may be removed until the caller stops.
+    def shuffled(self):
+        locations = self.locations
+        positions = self.positions
+        for i in range(len(locations)):
+            j = random.randrange(i, len(locations))
+            if j != i:
+                locations[i], locations[j] = locations[j], locations[i]
+                positions[locations[i]] = i
+                positions[locations[j]] = j
+            yield locations[i]
+
+
+# Counts what's left of the locations each kind of item can go in while fill_restrictive
+# places every item, to fail as soon as some kind has more items left than empty locations.
+# A kind is only looked at when its first item gets placed, and kinds that can go in the
+# same locations are counted together: a group is a list of how many of their items are
+# left, how many of those locations are still empty, and one of the items.
+# If reachable is given, only the locations in it count.
+class SpotGroups(object):
+
+    def __init__(self, itempool, all_locations, reachable=None):
+        self.items_left = Counter((item.name, item.world.id) for item in itempool)
+        self.all_locations = all_locations
+        self.reachable = reachable
+        self.groups = {}
+        self.by_item = {}
+        self.by_location = defaultdict(list)
+
+
+    # Adds the kind of the item to the group of the locations it can go in, from the ones
+    # out of all_locations it passes can_fill_fast for, unless it's in one already.
+    def add(self, item, fast_locations, locations, itempool):
+        item_key = (item.name, item.world.id)
+        if item_key in self.by_item:
+            return
+        # Kinds that can go anywhere share a group by whether they're major items,
+        # which saves going through every location for each of them
+        anywhere = len(fast_locations) == len(self.all_locations)
+        key = item.majoritem if anywhere else self.spots(item, fast_locations)
+        group = self.groups.get(key)
+        if group is None:
+            spots = self.spots(item, self.all_locations) if anywhere else key
+            group = self.groups[key] = [0, sum(1 for l in spots if l in locations), item]
+            for location in spots:
+                self.by_location[location].append(group)
+        group[0] += self.items_left[item_key]
+        self.by_item[item_key] = group
+        check_spots_left(group, itempool)
+
+
+    # Returns the given locations that count for the item.
+    def spots(self, item, locations):
+        return frozenset(l for l in locations if (self.reachable is None or l in self.reachable)
+                                                 and not (item.majoritem and l.minor_only))
+
+
+    # Counts the item as placed in the location, whose groups have one empty location less.
+    def place(self, item, location, itempool):
+        self.by_item[(item.name, item.world.id)][0] -= 1
+        for spots_left in self.by_location.get(location, ()):
+            spots_left[1] -= 1
+            check_spots_left(spots_left, itempool)
+
+
 # Places items in the itempool into locations.
 # worlds is a list of worlds and is redundant of the worlds in the base_state_list
 # base_state_list is a list of world states prior to placing items in the item pool
@@ -396,12 +506,35 @@ def fill_ownworld_restrictive(window, worlds, search, locations, ownpool, itempo
 # those two lists cannot be guaranteed.
 def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1):
     unplaced_items = []
+    locations = LocationPool(locations)
 
     # don't run over this search, just keep it as an item collection
     items_search = base_search.copy()
     items_search.collect_all(itempool)
     logging.getLogger('').debug(f'Placing {len(itempool)} items among {len(locations)} potential locations.')
     itempool.sort(key=lambda item: not item.priority)
+    # The locations each kind of item passes can_fill_fast for. Region and item rules
+    # only look at the item's name and world and don't change while filling,
+    # so this is worked out once per kind instead of for every item and location.
+    fast_locations_by_item = {}
+    fast_locations_from = locations
+    max_search = None
+    if count < 0:
+        # Every item has to be placed, so a fill that runs out of spots for some kind of
+        # them fails as soon as that's certain instead of when it gets to the last of them.
+        # Kinds are looked at over all the locations, filled or not, so the ones that can
+        # go in the same locations are counted together.
+        fast_locations_from = list(locations)
+        reachable = None
+        if not worlds[0].check_beatable_only:
+            # Every item also has to be placed somewhere reachable, and while they are
+            # nothing gets reachable that wasn't with all of them, so only those spots count.
+            # This search is where the first max search is taken over from.
+            max_search = items_search.copy()
+            max_search.start_trail()
+            max_search.collect_locations()
+            reachable = {location for location in fast_locations_from if max_search.spot_access(location, 'either')}
+        spot_groups = SpotGroups(itempool, fast_locations_from, reachable)
 
     # loop until there are no items or locations
     while itempool and locations:
@@ -411,18 +544,30 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
 
         # get an item and remove it from the itempool
         item_to_place = itempool.pop()
+        item_key = (item_to_place.name, item_to_place.world.id)
+        if item_key not in fast_locations_by_item:
+            fast_locations_by_item[item_key] = {l for l in fast_locations_from if l.can_fill_fast(item_to_place)}
+        fast_locations = fast_locations_by_item[item_key]
+        if count < 0:
+            spot_groups.add(item_to_place, fast_locations, locations, itempool)
         if item_to_place.priority:
-            l2cations = [l for l in locations if l.can_fill_fast(item_to_place)]
+            l2cations = (l for l in locations.shuffled() if l in fast_locations)
         elif item_to_place.majoritem:
-            l2cations = [l for l in locations if not l.minor_only]
+            l2cations = (l for l in locations.shuffled() if not l.minor_only)
         else:
-            l2cations = locations
-        random.shuffle(l2cations)
+            l2cations = locations.shuffled()
 
         # generate the max search with every remaining item
-        # this will allow us to place this item in a reachable location
+        # this will allow us to place this item in a reachable location.
+        # What the last one reached that doesn't need this item is taken over
+        # instead of explored again.
         items_search.uncollect(item_to_place)
+        last_max_search = max_search
         max_search = items_search.copy()
+        if last_max_search is None:
+            max_search.start_trail()
+        else:
+            max_search.replay(last_max_search)
         max_search.collect_locations()
 
         # perform_access_check checks location reachability
@@ -442,8 +587,10 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
         # find a location that the item can be placed. It must be a valid location
         # in the world we are placing it (possibly checking for reachability)
         spot_to_fill = None
+        tried = 0
         for location in l2cations:
-            if location.can_fill(max_search.state_list[location.world.id], item_to_place, perform_access_check):
+            tried += 1
+            if location in fast_locations and location.can_fill(max_search.state_list[location.world.id], item_to_place, perform_access_check, fast_checked=True):
                 # for multiworld, make it so that the location is also reachable
                 # in the world the item is for. This is to prevent early restrictions
                 # in one world being placed late in another world. If this is not
@@ -488,13 +635,15 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
                 continue
             else:
                 # we expect all items to be placed
-                raise FillError('Game unbeatable: No more spots to place %s [World %d] from %d locations (%d total); %d other items left to place, plus %d skipped' % (item_to_place, item_to_place.world.id + 1, len(l2cations), len(locations), len(itempool), len(unplaced_items)))
+                raise FillError('Game unbeatable: No more spots to place %s [World %d] from %d locations (%d total); %d other items left to place, plus %d skipped' % (item_to_place, item_to_place.world.id + 1, tried, len(locations), len(itempool), len(unplaced_items)))
 
         # Place the item in the world and continue
         spot_to_fill.world.push_item(spot_to_fill, item_to_place)
         locations.remove(spot_to_fill)
         window.fillcount += 1
         window.update_progress(5 + ((window.fillcount / window.locationcount) * 30))
+        if count < 0:
+            spot_groups.place(item_to_place, spot_to_fill, itempool)
 
         # decrement count
         count -= 1
@@ -508,17 +657,24 @@ def fill_restrictive(window, worlds, base_search, locations, itempool, count=-1)
     itempool.extend(unplaced_items)
 
 
+# Raises a FillError if a group from SpotGroups has more items left than empty locations.
+def check_spots_left(spots_left, itempool):
+    items, spots, item = spots_left
+    if items > spots:
+        raise FillError('Not enough spots left: %d items like %s [World %d] can only go in %d remaining locations; %d items left to place' % (items, item, item.world.id + 1, spots, len(itempool)))
+
+
 # This places items in the itempool into the locations
 # It does not check for reachability, only that the item is
 # allowed in the location
 def fill_restrictive_fast(window, worlds, locations, itempool):
+    locations = LocationPool(locations)
     while itempool and locations:
         item_to_place = itempool.pop()
-        random.shuffle(locations)
 
         # get location that allows this item
         spot_to_fill = None
-        for location in locations:
+        for location in locations.shuffled():
             if location.can_fill_fast(item_to_place):
                 spot_to_fill = location
                 break
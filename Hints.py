@@ -1,7 +1,7 @@
 import logging
 import os
 import random
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
 import urllib.request
 from urllib.error import URLError, HTTPError
 import json
@@ -357,24 +357,41 @@ class HintArea(Enum):
     DESERT_COLOSSUS        = 'at',     'at',     'the Desert Colossus',        "Desert Colossus",        'Yellow',     None
     SPIRIT_TEMPLE          = 'inside', 'in',     'the Spirit Temple',          "Spirit Temple",          'Yellow',     'Spirit Temple'
 
+    # Returns the closest hint area from a given spot (region, location, or entrance), see find.
+    # Results are kept per world until an entrance in it is connected or disconnected.
+    @staticmethod
+    def at(spot, use_alt_hint=False):
+        world = spot.world
+        key = (spot, use_alt_hint)
+        cached = world.hint_area_cache.get(key)
+        if cached is None or cached[0] != world.graph_version:
+            try:
+                area = HintArea.find(spot, use_alt_hint)
+            except HintAreaNotFound:
+                area = None
+            cached = world.hint_area_cache[key] = (world.graph_version, area)
+        if cached[1] is None:
+            raise HintAreaNotFound('No hint area could be found for %s [World %d]' % (spot, spot.world.id))
+        return cached[1]
+
     # Performs a breadth first search to find the closest hint area from a given spot (region, location, or entrance).
     # May fail to find a hint if the given spot is only accessible from the root and not from any other region with a hint area
     @staticmethod
-    def at(spot, use_alt_hint=False):
+    def find(spot, use_alt_hint=False):
         if isinstance(spot, Region):
             original_parent = spot
         else:
             original_parent = spot.parent_region
-        already_checked = []
-        spot_queue = [spot]
-        fallback_spot_queue = []
+        already_checked = set()
+        spot_queue = deque([spot])
+        fallback_spot_queue = deque()
 
         while spot_queue or fallback_spot_queue:
             if not spot_queue:
                 spot_queue = fallback_spot_queue
-                fallback_spot_queue = []
-            current_spot = spot_queue.pop(0)
-            already_checked.append(current_spot)
+                fallback_spot_queue = deque()
+            current_spot = spot_queue.popleft()
+            already_checked.add(current_spot)
 
             if isinstance(current_spot, Region):
                 parent_region = current_spot
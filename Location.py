@@ -84,12 +84,13 @@ class Location(object):
         self.access_rules = [lambda_rule]
 
 
-    def can_fill(self, state, item, check_access=True):
+    # fast_checked skips can_fill_fast when the caller already knows it passes.
+    def can_fill(self, state, item, check_access=True, fast_checked=False):
         if self.minor_only and item.majoritem:
             return False
         return (
             not self.is_disabled() and
-            self.can_fill_fast(item) and
+            (fast_checked or self.can_fill_fast(item)) and
             (not check_access or state.search.spot_access(self, 'either'))
         )
 
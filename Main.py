@@ -1,10 +1,13 @@
 from collections import OrderedDict
 import copy
+import functools
 import hashlib
 import io
 import itertools
 import logging
+import multiprocessing
 import os
+import pickle
 import platform
 import random
 import shutil
@@ -19,13 +22,12 @@ from Spoiler import Spoiler
 from Rom import Rom
 from Patches import patch_rom
 from Cosmetics import patch_cosmetics
-from Dungeon import create_dungeons
 from Fill import distribute_items_restrictive, ShuffleError
 from Item import Item
 from ItemPool import generate_itempool
 from Hints import buildGossipHints
 from HintList import clearHintExclusionCache, misc_item_hint_table, misc_location_hint_table
-from Utils import default_output_path, is_bundled, run_process, data_path
+from Utils import default_output_path, is_bundled, run_process
 from Models import patch_model_adult, patch_model_child
 from N64Patch import create_patch_file, apply_patch_file
 from MBSDIFFPatch import apply_ootr_3_web_patch
@@ -36,6 +38,8 @@ from Search import Search, RewindableSearch
 from EntranceShuffle import set_entrances
 from LocationList import set_drop_location_names
 from Goals import update_goal_items, maybe_set_misc_item_hints, replace_goal_names
+from JSONDump import dump_obj
+import Profiler
 from version import __version__
 
 
@@ -52,27 +56,158 @@ def main(settings, window=dummy_window(), max_attempts=10):
     clearHintExclusionCache()
     logger = logging.getLogger('')
     start = time.process_time()
+    if settings.profile_generation or settings.profile_rules:
+        Profiler.start(settings.profile_memory, settings.profile_rules)
 
-    rom = resolve_settings(settings, window=window)
+    try:
+        with Profiler.phase('resolve_settings'):
+            rom = resolve_settings(settings, window=window)
 
-    max_attempts = max(max_attempts, 1)
-    spoiler = None
-    for attempt in range(1, max_attempts + 1):
-        try:
-            spoiler = generate(settings, window=window)
-            break
-        except ShuffleError as e:
-            logger.warning('Failed attempt %d of %d: %s', attempt, max_attempts, e)
-            if attempt >= max_attempts:
-                raise
-            else:
-                logger.info('Retrying...\n\n')
-            settings.reset_distribution()
-    patch_and_output(settings, window, spoiler, rom)
+        max_attempts = max(max_attempts, 1)
+        spoiler = None
+        if settings.attempt_workers != 1 and max_attempts > 1:
+            spoiler = generate_concurrently(settings, window, max_attempts, settings.attempt_workers)
+        else:
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    with Profiler.phase('attempt %d' % attempt):
+                        spoiler = generate(settings, window=window)
+                    break
+                except ShuffleError as e:
+                    logger.warning('Failed attempt %d of %d: %s', attempt, max_attempts, e)
+                    if attempt >= max_attempts:
+                        raise
+                    else:
+                        logger.info('Retrying...\n\n')
+                    settings.reset_distribution()
+        with Profiler.phase('patch_and_output'):
+            patch_and_output(settings, window, spoiler, rom)
+    finally:
+        profiler = Profiler.stop()
+    if profiler is not None:
+        write_profile(settings, profiler)
     logger.debug('Total Time: %s', time.process_time() - start)
     return spoiler
 
 
+# Writes the phases of generating the seed, and the rules it spent the most time in
+# if they were counted, next to its spoiler
+def write_profile(settings, profiler):
+    logger = logging.getLogger('')
+    profile = {
+        'version':         __version__,
+        'seed':            settings.seed,
+        'settings_string': settings.settings_string,
+        'world_count':     settings.world_count,
+    }
+    profile.update(profiler.to_json())
+    profile_path = os.path.join(default_output_path(settings.output_dir), '%s_Profile.json' % get_output_filename_base(settings))
+    with open(profile_path, 'w') as outfile:
+        outfile.write(dump_obj(profile))
+    logger.info("Created profile at: %s" % profile_path)
+    if profiler.count_rules:
+        logger.info('Rules that took the most time:')
+        for rule in Profiler.hot_rules(10):
+            logger.info('%8.4fs %8d calls  %s: %s', rule['self_time'], rule['calls'], rule['spot'], rule['rule'])
+
+
+# Runs the generation attempts in worker processes (as many as there are CPUs
+# if workers is 0 or None) instead of one after the other. Every attempt after
+# the first gets its own random stream derived from the seed, so the lowest
+# numbered attempt that succeeds is the same however many run at once.
+# The first attempt is made here while the workers make the others, so when it
+# succeeds, as it usually does, nothing is generated twice. Otherwise, since a
+# worker's spoiler can't be sent back, the first attempt a worker made is
+# generated again here. That isn't always the same in another process, so if it
+# fails here, it counts as failed and the next one is taken.
+def generate_concurrently(settings, window, max_attempts, workers):
+    logger = logging.getLogger('')
+    rng_state = random.getstate()
+    # Pickled once for all the attempts
+    settings_data = pickle.dumps(settings)
+    # This process makes an attempt too
+    processes = max((workers or os.cpu_count() or 1) - 1, 1)
+    # A Pool, unlike an executor, can stop the attempts still running once we have ours
+    pool = multiprocessing.Pool(processes, initializer=init_batch_worker, initargs=(logger.getEffectiveLevel(),))
+    try:
+        results = [pool.apply_async(try_attempt, (settings_data, rng_state, attempt)) for attempt in range(2, max_attempts + 1)]
+        for attempt in range(1, max_attempts + 1):
+            if attempt > 1:
+                error = results[attempt - 2].get()
+                if error is not None:
+                    logger.warning('Failed attempt %d of %d: %s', attempt, max_attempts, error)
+                    continue
+            seed_attempt(settings, rng_state, attempt)
+            try:
+                with Profiler.phase('attempt %d' % attempt):
+                    return generate(settings, window=window)
+            except ShuffleError as e:
+                error = str(e)
+                logger.warning('Failed attempt %d of %d: %s', attempt, max_attempts, e)
+                settings.reset_distribution()
+    finally:
+        pool.terminate()
+    raise ShuffleError(error)
+
+
+def seed_attempt(settings, rng_state, attempt):
+    if attempt == 1:
+        random.setstate(rng_state)
+    else:
+        random.seed('%d-%d' % (settings.numeric_seed, attempt))
+
+
+# Returns why the attempt failed, or None if it succeeded.
+def try_attempt(settings_data, rng_state, attempt):
+    settings = pickle.loads(settings_data)
+    seed_attempt(settings, rng_state, attempt)
+    try:
+        generate(settings)
+    except ShuffleError as e:
+        return str(e)
+    return None
+
+
+# Generates settings.count seeds, named like the sequential --count loop does,
+# across worker processes (as many as there are CPUs if workers is 0 or None).
+# Each seed starts from a copy of the given settings, and workers keep their
+# imports and rule caches warm between seeds.
+# Logs each seed's result as it finishes and returns them all in seed order
+# as (seed, error or None, generation time, output path without extension).
+def main_batch(settings, workers=None):
+    logger = logging.getLogger('')
+    seeds = [settings.seed + '-' + str(i) for i in range(settings.count)]
+    results = {}
+    with multiprocessing.Pool(workers or None, initializer=init_batch_worker, initargs=(logger.getEffectiveLevel(),)) as pool:
+        for seed, error, seconds, output_path in pool.imap_unordered(functools.partial(generate_batch_seed, settings), seeds):
+            if error is None:
+                logger.info('Seed %s done in %.2fs: %s', seed, seconds, output_path)
+            else:
+                logger.error('Seed %s failed after %.2fs: %s', seed, seconds, error)
+            results[seed] = (seed, error, seconds, output_path)
+    return [results[seed] for seed in seeds]
+
+
+def init_batch_worker(loglevel):
+    # Workers that don't inherit the parent's logging still need to report at its level
+    logging.basicConfig(format='%(message)s', level=loglevel)
+    # Nor do they record into a profiler they inherited; only the attempts the
+    # parent makes are profiled, and batch seeds start their own.
+    Profiler.stop()
+
+
+def generate_batch_seed(settings, seed):
+    start = time.process_time()
+    settings.update_seed(seed)
+    try:
+        main(settings)
+    except Exception as ex:
+        logging.getLogger('').exception(ex)
+        return seed, '%s: %s' % (type(ex).__name__, ex), time.process_time() - start, None
+    output_path = os.path.join(default_output_path(settings.output_dir), get_output_filename_base(settings))
+    return seed, None, time.process_time() - start, output_path
+
+
 def resolve_settings(settings, window=dummy_window()):
     logger = logging.getLogger('')
 
@@ -126,13 +261,16 @@ def resolve_settings(settings, window=dummy_window()):
 
 
 def generate(settings, window=dummy_window()):
-    worlds = build_world_graphs(settings, window=window)
-    place_items(settings, worlds, window=window)
+    with Profiler.phase('build_world_graphs'):
+        worlds = build_world_graphs(settings, window=window)
+    with Profiler.phase('place_items'):
+        place_items(settings, worlds, window=window)
     for world in worlds:
         world.distribution.configure_effective_starting_items(worlds, world)
     if worlds[0].enable_goal_hints:
         replace_goal_names(worlds)
-    return make_spoiler(settings, worlds, window=window)
+    with Profiler.phase('make_spoiler'):
+        return make_spoiler(settings, worlds, window=window)
 
 
 def build_world_graphs(settings, window=dummy_window()):
@@ -148,19 +286,7 @@ def build_world_graphs(settings, window=dummy_window()):
         window.update_progress(0 + 1*(id + 1)/settings.world_count)
         logger.info('Creating Overworld')
 
-        # Load common json rule files (those used regardless of MQ status)
-        if settings.logic_rules == 'glitched':
-            path = 'Glitched World'
-        else:
-            path = 'World'
-        path = data_path(path)
-
-        for filename in ('Overworld.json', 'Bosses.json'):
-            world.load_regions_from_json(os.path.join(path, filename))
-
-        # Compile the json rules based on settings
-        create_dungeons(world)
-        world.create_internal_locations()
+        world.load_graph()
 
         if settings.shopsanity != 'off':
             world.random_shop_prices()
@@ -181,7 +307,8 @@ def build_world_graphs(settings, window=dummy_window()):
         settings.distribution.configure_triforce_hunt(worlds)
 
     logger.info('Setting Entrances.')
-    set_entrances(worlds)
+    with Profiler.phase('set_entrances'):
+        set_entrances(worlds)
     return worlds
 
 
@@ -199,13 +326,16 @@ def make_spoiler(settings, worlds, window=dummy_window()):
     if settings.create_spoiler:
         window.update_status('Calculating Spoiler Data')
         logger.info('Calculating playthrough.')
-        create_playthrough(spoiler)
+        with Profiler.phase('create_playthrough'):
+            create_playthrough(spoiler)
         window.update_progress(50)
     if settings.create_spoiler or settings.hints != 'none':
         window.update_status('Calculating Hint Data')
         logger.info('Calculating hint data.')
-        update_goal_items(spoiler)
-        buildGossipHints(spoiler, worlds)
+        with Profiler.phase('update_goal_items'):
+            update_goal_items(spoiler)
+        with Profiler.phase('buildGossipHints'):
+            buildGossipHints(spoiler, worlds)
         window.update_progress(55)
     elif any(world.dungeon_rewards_hinted for world in worlds) or any(hint_type in settings.misc_hints for hint_type in misc_item_hint_table) or any(hint_type in settings.misc_hints for hint_type in misc_location_hint_table):
         find_misc_hint_items(spoiler)
@@ -224,8 +354,10 @@ def prepare_rom(spoiler, world, rom, settings, rng_state=None, restore=True):
 
     if restore:
         rom.restore()
-    patch_rom(spoiler, world, rom)
-    cosmetics_log = patch_cosmetics(settings, rom)
+    with Profiler.phase('patch_rom'):
+        patch_rom(spoiler, world, rom)
+    with Profiler.phase('patch_cosmetics'):
+        cosmetics_log = patch_cosmetics(settings, rom)
     if not settings.generating_patch_file:
         if settings.model_adult != "Default" or len(settings.model_adult_filepicker) > 0:
             patch_model_adult(rom, settings, cosmetics_log)
@@ -313,19 +445,22 @@ def generate_wad(wad_file, rom_file, output_file, channel_title, channel_id, win
         os.remove(rom_file)
 
 
+def get_output_filename_base(settings):
+    settings_string_hash = hashlib.sha1(settings.settings_string.encode('utf-8')).hexdigest().upper()[:5]
+    if settings.output_file:
+        return settings.output_file
+    output_filename_base = f"OoT_{settings_string_hash}_{settings.seed}"
+    if settings.world_count > 1:
+        output_filename_base += f"_W{settings.world_count}"
+    return output_filename_base
+
+
 def patch_and_output(settings, window, spoiler, rom):
     logger = logging.getLogger('')
     worlds = spoiler.worlds
     cosmetics_log = None
 
-    settings_string_hash = hashlib.sha1(settings.settings_string.encode('utf-8')).hexdigest().upper()[:5]
-    if settings.output_file:
-        output_filename_base = settings.output_file
-    else:
-        output_filename_base = f"OoT_{settings_string_hash}_{settings.seed}"
-        if settings.world_count > 1:
-            output_filename_base += f"_W{settings.world_count}"
-
+    output_filename_base = get_output_filename_base(settings)
     output_dir = default_output_path(settings.output_dir)
 
     compressed_rom = settings.create_compressed_rom or settings.create_wad_file
@@ -360,7 +495,8 @@ def patch_and_output(settings, window, spoiler, rom):
                 log_and_update_window(window, f"Creating Patch File: {patch_filename}")
                 output_path = os.path.join(output_dir, patch_filename)
                 file_list.append(patch_filename)
-                create_patch_file(rom, output_path)
+                with Profiler.phase('create_patch_file'):
+                    create_patch_file(rom, output_path)
                 window.update_progress(65 + 30*(world.id + 1)/settings.world_count)
 
                 # Cosmetics Log for patch file only.
@@ -395,7 +531,8 @@ def patch_and_output(settings, window, spoiler, rom):
             compressed_filename = f"{output_filename_base}{player_filename_suffix}.z64"
             compressed_path = os.path.join(output_dir, compressed_filename)
             log_and_update_window(window, f"Compressing ROM: {compressed_filename}")
-            compress_rom(uncompressed_path, compressed_path, window, not settings.create_uncompressed_rom)
+            with Profiler.phase('compress_rom'):
+                compress_rom(uncompressed_path, compressed_path, window, not settings.create_uncompressed_rom)
             logger.info("Created compressed ROM at: %s" % compressed_path)
 
             # If we aren't generating a WAD, we're done with this world.
@@ -763,7 +900,7 @@ def create_playthrough(spoiler):
             if search.state_list[old_item.world.id].item_count(old_item.solver_id) < old_item.world.max_progressions[old_item.name]:
                 # Test whether the game is still beatable from here.
                 logger.debug('Checking if %s is required to beat the game.', old_item.name)
-                if not search.can_beat_game():
+                if not search.can_still_beat_game():
                     # still required, so reset the item
                     location.item = old_item
                     required_locations.append(location)
@@ -8,7 +8,7 @@ import datetime
 import sys
 
 from Gui import guiMain
-from Main import main, from_patch_file, cosmetic_patch, diff_roms
+from Main import main, main_batch, from_patch_file, cosmetic_patch, diff_roms
 from Utils import check_version, VersionError, check_python_version, local_path
 from Settings import get_settings_from_command_line_args
 
@@ -55,6 +55,12 @@ def start():
             cosmetic_patch(settings)
         elif settings.patch_file != '':
             from_patch_file(settings)
+        elif settings.count != None and settings.count > 1 and settings.count_workers != 1:
+            results = main_batch(settings, settings.count_workers)
+            failed = [seed for seed, error, _, _ in results if error is not None]
+            if failed:
+                logger.error('%d of %d seeds failed: %s', len(failed), len(results), ', '.join(failed))
+                sys.exit(1)
         elif settings.count != None and settings.count > 1:
             orig_seed = settings.seed
             for i in range(settings.count):
@@ -4,7 +4,7 @@ import math
 import re
 import random
 
-from functools import reduce
+from functools import partial, reduce
 from collections import defaultdict
 
 from Fill import FillError
@@ -1036,7 +1036,7 @@ class WorldDistribution(object):
 
     @property
     def starting_items(self):
-        data = defaultdict(lambda: StarterRecord(0))
+        data = defaultdict(partial(StarterRecord, 0))
         world_names = ['World %d' % (i + 1) for i in range(len(self.distribution.world_dists))]
 
         # For each entry here of the form 'World %d', apply that entry to that world.
@@ -1226,7 +1226,7 @@ class Distribution(object):
 
         # normalize starting items to use the dictionary format
         starting_items = itertools.chain(self.settings.starting_equipment, self.settings.starting_songs)
-        data = defaultdict(lambda: StarterRecord(0))
+        data = defaultdict(partial(StarterRecord, 0))
         if isinstance(self.settings.starting_items, dict) and self.settings.starting_items:
             world_names = ['World %d' % (i + 1) for i in range(len(self.world_dists))]
             for name, record in self.settings.starting_items.items():
@@ -0,0 +1,173 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import time
+import tracemalloc
+
+from JSONDump import CollapseDict
+
+
+# Each phase can only have a peak memory of its own with tracemalloc.reset_peak
+can_trace_memory = hasattr(tracemalloc, 'reset_peak')
+
+
+# Records the wall time, CPU time and counts of some of the work done in each phase
+# of generating a seed, and their peak memory if asked to, so the numbers can be
+# compared across versions. Tracing memory slows everything else down, so the times
+# of a run that traces it shouldn't be compared with those of one that doesn't.
+# Phases can be nested. Each is recorded under the names of the phases around it,
+# in the order they finish. With count_rules, the rules wrapped by count_rule_calls
+# are listed too, by the time they took.
+class Profiler(object):
+
+    def __init__(self, trace_memory=False, count_rules=False):
+        if trace_memory and not can_trace_memory:
+            raise RuntimeError('Profiling memory needs Python 3.9 or newer.')
+        self.trace_memory = trace_memory
+        self.count_rules = count_rules
+        self.counters = Counter()
+        self.phases = []
+        # The phases running: their name, start times, counters and peak memory so far
+        self.stack = []
+        self.started_tracing = False
+
+
+    def start(self):
+        if self.count_rules:
+            rule_calls.clear()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.enter('total')
+
+
+    def stop(self):
+        while self.stack:
+            self.leave()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+
+    def enter(self, name):
+        if self.stack:
+            name = self.stack[-1][0] + '/' + name
+        if self.trace_memory:
+            self.note_peak()
+            tracemalloc.reset_peak()
+        self.stack.append([name, time.perf_counter(), time.process_time(), self.counters.copy(), 0])
+
+
+    def leave(self, error=None):
+        name, wall, cpu, counters, peak = self.stack.pop()
+        phase = CollapseDict(
+            phase = name,
+            wall  = round(time.perf_counter() - wall, 4),
+            cpu   = round(time.process_time() - cpu, 4),
+        )
+        if self.trace_memory:
+            phase['peak_memory'] = max(peak, tracemalloc.get_traced_memory()[1])
+            # The phase around this one peaked at least as high
+            if self.stack:
+                self.stack[-1][4] = max(self.stack[-1][4], phase['peak_memory'])
+            tracemalloc.reset_peak()
+        phase['counters'] = CollapseDict(sorted((self.counters - counters).items()))
+        if error is not None:
+            phase['error'] = error
+        self.phases.append(phase)
+
+
+    # The peak since it was last reset belongs to the phase running then
+    def note_peak(self):
+        if self.stack:
+            self.stack[-1][4] = max(self.stack[-1][4], tracemalloc.get_traced_memory()[1])
+
+
+    def to_json(self):
+        json = {
+            'trace_memory': self.trace_memory,
+            'counters':     CollapseDict(sorted(self.counters.items())),
+            'phases':       self.phases,
+        }
+        if self.count_rules:
+            json['hot_rules'] = [CollapseDict(rule) for rule in hot_rules()]
+        return json
+
+
+# The profiler recording the current generation, if there is one
+active = None
+
+# The calls to the rules wrapped by count_rule_calls, by spot name and rule:
+# how many there were, the time they took, and the time they took themselves,
+# without the rules they evaluated in turn (like those of can_reach).
+rule_calls = defaultdict(lambda: [0, 0.0, 0.0])
+# The time taken by the rules evaluated within the one running now
+nested_rule_time = [0.0]
+
+
+def start(trace_memory=False, count_rules=False):
+    global active
+    active = Profiler(trace_memory, count_rules)
+    active.start()
+    return active
+
+
+def stop():
+    global active
+    profiler = active
+    active = None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+# Records what's run in the with block as a phase, if a profiler is running
+@contextmanager
+def phase(name):
+    profiler = active
+    if profiler is None:
+        yield
+        return
+    profiler.enter(name)
+    try:
+        yield
+    except BaseException as e:
+        profiler.leave(type(e).__name__)
+        raise
+    profiler.leave()
+
+
+def count(name, amount=1):
+    if active is not None:
+        active.counters[name] += amount
+
+
+# Returns the rule counting its calls into rule_calls, under the name of the spot
+# it's evaluated for and the given text of the rule.
+def count_rule_calls(rule, rule_text):
+    def counted_rule(state, **kwargs):
+        spot = kwargs.get('spot')
+        outer_time = nested_rule_time[0]
+        nested_rule_time[0] = 0.0
+        start = time.perf_counter()
+        try:
+            return rule(state, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            calls = rule_calls[(spot and spot.name, rule_text)]
+            calls[0] += 1
+            calls[1] += elapsed
+            calls[2] += elapsed - nested_rule_time[0]
+            nested_rule_time[0] = outer_time + elapsed
+    return counted_rule
+
+
+# The counted rules, the ones that took the most time themselves first
+def hot_rules(limit=None):
+    rules = sorted(rule_calls.items(), key=lambda item: item[1][2], reverse=True)
+    return [{
+        'spot':      spot_name,
+        'rule':      rule_text,
+        'calls':     calls,
+        'time':      round(total_time, 4),
+        'self_time': round(self_time, 4),
+    } for (spot_name, rule_text), (calls, total_time, self_time) in rules[:limit]]
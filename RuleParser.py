@@ -1,13 +1,18 @@
 import ast
 from collections import defaultdict
+import hashlib
+import importlib.util
 import logging
+import os
+import pickle
 import re
 
 from Item import ItemInfo, Item, MakeEventItem
 from Location import Location
+from Profiler import count_rule_calls
 from Region import TimeOfDay
 from RulesCommon import allowed_globals, escape_name
-from State import State
+from State import State, solver_mask
 from Utils import data_path, read_logic_file
 
 
@@ -49,6 +54,143 @@ def isliteral(expr):
     return isinstance(expr, (ast.Num, ast.Str, ast.Bytes, ast.NameConstant))
 
 
+# The number of a numeric literal. Before Python 3.8, they are ast.Num nodes,
+# which have it as n instead of value.
+def num_value(node):
+    return node.value if hasattr(node, 'value') else node.n
+
+
+# State functions that take the items to check as their first argument
+item_checks = ('has', 'has_any_of', 'has_all_of', 'count_of', 'item_count')
+# State functions that take a bitmask of the items to check
+mask_checks = ('has_any_of_mask', 'has_all_of_mask')
+
+# Solver ids read by the other State functions usable in logic.
+# Functions that only look at world data or settings read no items.
+state_dependencies = {
+    'has_bottle': frozenset(ItemInfo.bottle_ids | {ItemInfo.solver_ids['Rutos_Letter']}),
+    'has_hearts': frozenset([ItemInfo.solver_ids['Piece_of_Heart']]),
+    'has_medallions': frozenset(ItemInfo.medallion_ids),
+    'has_stones': frozenset(ItemInfo.stone_ids),
+    'has_dungeon_rewards': frozenset(ItemInfo.medallion_ids | ItemInfo.stone_ids),
+    'had_night_start': frozenset(),
+    'can_live_dmg': frozenset(),
+    'region_has_shortcuts': frozenset(),
+}
+
+
+# Returns a bitmask of the solver ids a transformed rule reads from the state,
+# or None if the rule may change for other reasons (eg. it asks the search
+# whether a region is reachable), in which case it has to be re-evaluated every time.
+def rule_dependencies(body):
+    deps = 0
+    nodes = [body]
+    while nodes:
+        node = nodes.pop()
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and isinstance(node.func.value, ast.Name) and node.func.value.id == 'state'):
+            if node.func.attr in item_checks:
+                items = node.args[0]
+                for item in (items.elts if isinstance(items, ast.Tuple) else [items]):
+                    if not isinstance(item, ast.Name) or item.id not in ItemInfo.solver_ids:
+                        return None
+                    deps |= 1 << ItemInfo.solver_ids[item.id]
+                nodes.extend(node.args[1:])
+            elif node.func.attr in mask_checks:
+                deps |= num_value(node.args[0])
+            elif node.func.attr in state_dependencies:
+                deps |= sum(1 << solver_id for solver_id in state_dependencies[node.func.attr])
+                nodes.extend(node.args)
+                nodes.extend(kw.value for kw in node.keywords)
+            else:
+                return None
+        elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'state':
+            # World data and settings don't change once the rules are built
+            if node.attr != 'world':
+                return None
+        elif isinstance(node, ast.Name) and node.id == 'state':
+            return None
+        else:
+            nodes.extend(ast.iter_child_nodes(node))
+    return deps
+
+
+# Bump when the cached data changes format.
+rule_cache_version = 2
+
+
+# Hash of everything a logic file's rules depend on, other than the world and
+# settings values folded into them: the file itself, the transformer, the helpers,
+# the files loaded before it in this world (which determine the subrule names),
+# and which names are world or settings attributes.
+def rule_file_hash(world, file_path, loaded_files):
+    file_hash = hashlib.sha256()
+    file_hash.update(b'%d' % rule_cache_version)
+    for path in (__file__, data_path('LogicHelpers.json'), *loaded_files, file_path):
+        with open(path, 'rb') as f:
+            file_hash.update(hashlib.sha256(f.read()).digest())
+    file_hash.update(repr(sorted(world.__dict__)).encode())
+    file_hash.update(repr(sorted(world.settings.__dict__)).encode())
+    return file_hash.hexdigest()
+
+
+# Rewrites the bitmasks of a cached rule for the solver ids of this run,
+# since events get their ids in the order they are first seen.
+class Mask_Remapper(ast.NodeTransformer):
+
+    def __init__(self, remap):
+        self.remap = remap
+
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if isinstance(node.func, ast.Attribute) and node.func.attr in mask_checks:
+            mask = num_value(node.args[0])
+            node.args[0] = ast.Num(solver_mask(self.remap[i] for i in range(mask.bit_length()) if mask >> i & 1))
+        return node
+
+
+# Returns every solver id used by the given rule bodies.
+def rule_solver_ids(bodies):
+    ids = set()
+    for body in bodies:
+        for node in ast.walk(body):
+            if isinstance(node, ast.Name) and node.id in ItemInfo.solver_ids:
+                ids.add(ItemInfo.solver_ids[node.id])
+            elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and node.func.attr in mask_checks):
+                mask = num_value(node.args[0])
+                ids.update(i for i in range(mask.bit_length()) if mask >> i & 1)
+    return ids
+
+
+# Generates the source of a module defining the given rules as functions,
+# so Python's bytecode cache applies to them and they show up by name in profiles.
+# Identical rules only appear once, as they are already shared through the rule cache.
+def rules_module_source(rules):
+    signature = ', '.join(f'{k}={v!r}' for k, v in kwarg_defaults.items())
+    lines = [
+        '# Generated by RuleParser from the logic files, do not edit.',
+        'from RulesCommon import allowed_globals',
+        'globals().update(allowed_globals)',
+    ]
+    for name, body in rules:
+        lines.extend(['', '', f'def {name}(state, *, {signature}):', f'    return {ast.unparse(body)}'])
+    return '\n'.join(lines) + '\n'
+
+
+# Modules of generated rules imported so far, by path
+rules_modules = {}
+
+def import_rules_module(path):
+    if path not in rules_modules:
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        rules_modules[path] = module
+    return rules_modules[path]
+
+
 class Rule_AST_Transformer(ast.NodeTransformer):
 
     def __init__(self, world):
@@ -63,6 +205,18 @@ class Rule_AST_Transformer(ast.NodeTransformer):
             load_aliases()
         # final rule cache
         self.rule_cache = {}
+        # logic files parsed so far, and the on-disk cache entry
+        # being recorded or replayed for the current one (see start_file)
+        self.loaded_files = []
+        self.cache_file_hash = None
+        self.cache_key = None
+        self.cache_entry = None
+        self.cached_rules = None
+        self.cached_functions = None
+        # world and settings values folded into the rules being recorded
+        self.folded_values = None
+        # and into any rules of this world, including those replayed from the cache
+        self.all_folded_values = set()
 
 
     def visit_Name(self, node):
@@ -83,10 +237,10 @@ class Rule_AST_Transformer(ast.NodeTransformer):
                 args=[node],
                 keywords=[])
         elif node.id in self.world.__dict__:
-            return ast.parse('%r' % self.world.__dict__[node.id], mode='eval').body
+            return ast.parse('%r' % self.world_value(node.id), mode='eval').body
         elif node.id in self.world.settings.__dict__:
             # Settings are constant
-            return ast.parse('%r' % self.world.settings.__dict__[node.id], mode='eval').body
+            return ast.parse('%r' % self.setting_value(node.id), mode='eval').body
         elif node.id in State.__dict__:
             return self.make_call(node, node.id, [], [])
         elif node.id in kwarg_defaults or node.id in special_globals:
@@ -142,7 +296,7 @@ class Rule_AST_Transformer(ast.NodeTransformer):
 
         if isinstance(count, ast.Name):
             # Must be a settings constant
-            count = ast.parse('%r' % self.world.settings.__dict__[count.id], mode='eval').body
+            count = ast.parse('%r' % self.setting_value(count.id), mode='eval').body
 
         if item.id not in ItemInfo.solver_ids:
             self.events.add(item.id.replace('_', ' '))
@@ -291,12 +445,17 @@ class Rule_AST_Transformer(ast.NodeTransformer):
         early_return = isinstance(node.op, ast.Or)
         groupable = 'has_any_of' if early_return else 'has_all_of'
         items = set()
+        mask = 0
         new_values = []
         # if any elt is True(And)/False(Or), we can omit it
         # if any is False(And)/True(Or), the whole node can be replaced with it
         for elt in list(node.values):
             if isinstance(elt, ast.Str):
-                items.add(escape_name(elt.s))
+                esc = escape_name(elt.s)
+                if esc not in ItemInfo.solver_ids:
+                    self.events.add(esc.replace('_', ' '))
+                    Item(esc, event=True)
+                items.add(esc)
             elif (isinstance(elt, ast.Name) and elt.id not in rule_aliases
                     and elt.id not in self.world.__dict__
                     and elt.id not in self.world.settings.__dict__
@@ -320,32 +479,71 @@ class Rule_AST_Transformer(ast.NodeTransformer):
                         items.add(args.id)
                     else:
                         items.update(it.id for it in args.elts)
+                elif (isinstance(elt, ast.Call) and isinstance(elt.func, ast.Attribute)
+                        and elt.func.attr == groupable + '_mask'):
+                    mask |= num_value(elt.args[0])
                 elif isinstance(elt, ast.BoolOp) and node.op.__class__ == elt.op.__class__:
                     new_values.extend(elt.values)
                 else:
                     new_values.append(elt)
 
         # package up the remaining items and values
-        if not items and not new_values:
+        if not items and not mask and not new_values:
             # all values were True(And)/False(Or)
             return ast.NameConstant(not early_return)
 
+        # Items with a solver id are checked all at once with a bitmask,
+        # anything else is looked up by name when the rule runs.
+        mask |= solver_mask(ItemInfo.solver_ids[i] for i in items if i in ItemInfo.solver_ids)
+        items = [i for i in items if i not in ItemInfo.solver_ids]
+        grouped = []
+        if mask:
+            grouped.append(ast.Call(
+                func=ast.Attribute(
+                    value=ast.Name(id='state', ctx=ast.Load()),
+                    attr=groupable + '_mask',
+                    ctx=ast.Load()),
+                args=[ast.Num(mask)],
+                keywords=[]))
         if items:
-            node.values = [ast.Call(
+            grouped.append(ast.Call(
                 func=ast.Attribute(
                     value=ast.Name(id='state', ctx=ast.Load()),
-                    attr='has_any_of' if early_return else 'has_all_of',
+                    attr=groupable,
                     ctx=ast.Load()),
                 args=[ast.Tuple(elts=[ast.Name(id=i, ctx=ast.Load()) for i in items],
                                 ctx=ast.Load())],
-                keywords=[])] + new_values
-        else:
-            node.values = new_values
+                keywords=[]))
+        node.values = grouped + new_values
         if len(node.values) == 1:
             return node.values[0]
         return node
 
 
+    # Reads a world attribute to fold into a rule as a constant.
+    def world_value(self, name):
+        self.all_folded_values.add(('world', name))
+        if self.folded_values is not None:
+            self.folded_values.add(('world', name))
+        return self.world.__dict__[name]
+
+
+    # Reads a setting to fold into a rule as a constant.
+    def setting_value(self, name):
+        self.all_folded_values.add(('settings', name))
+        if self.folded_values is not None:
+            self.folded_values.add(('settings', name))
+        return self.world.settings.__dict__[name]
+
+
+    # Key of the cache entry for the current file with the given folded values,
+    # which also depends on the values they have in this world.
+    def rule_cache_key(self, folded_values):
+        values = [(source, name, repr((self.world if source == 'world' else self.world.settings).__dict__[name]))
+                  for source, name in folded_values]
+        return hashlib.sha256(f'{self.cache_file_hash}{values!r}'.encode()).hexdigest()
+
+
     # Generates an ast.Call invoking the given State function 'name',
     # providing given args and keywords, and adding in additional
     # keyword args from kwarg_defaults (age, etc.)
@@ -411,33 +609,47 @@ class Rule_AST_Transformer(ast.NodeTransformer):
         self.delayed_rules.clear()
 
 
-    def make_access_rule(self, body):
-        rule_str = ast.dump(body, False)
+    def make_access_rule(self, body, rule_str=None, function=None):
+        if rule_str is None:
+            rule_str = ast.dump(body, False)
         if rule_str not in self.rule_cache:
-            # requires consistent iteration on dicts
-            kwargs = [ast.arg(arg=k) for k in kwarg_defaults.keys()]
-            kwd = list(map(ast.Constant, kwarg_defaults.values()))
-            name = f'<{self.current_spot and self.current_spot.name}: {rule_str}>'
-            try:
-                self.rule_cache[rule_str] = eval(compile(
-                    ast.fix_missing_locations(
-                        ast.Expression(ast.Lambda(
-                            args=ast.arguments(
-                                posonlyargs=[],
-                                args=[ast.arg(arg='state')],
-                                defaults=[],
-                                kwonlyargs=kwargs,
-                                kw_defaults=kwd),
-                            body=body))),
-                    name, 'eval'),
-                    # globals/locals. if undefined, everything in the namespace *now* would be allowed
-                    # Intentionally modifiable so we can add the ItemInfo solver ids as we go
-                    allowed_globals)
-            except TypeError as e:
-                raise Exception('Parse Error: %s' % e, self.current_spot.name, ast.dump(body, False))
+            if function is None:
+                function = self.compile_rule(body, rule_str)
+            if self.world.settings.profile_rules:
+                function = count_rule_calls(function, ast.unparse(body) if hasattr(ast, 'unparse') else rule_str)
+            self.rule_cache[rule_str] = function
+            # Lets the search skip re-evaluating the rule until one of these items changes
+            self.rule_cache[rule_str].deps = deps = rule_dependencies(body)
+            # Rules that only read items give the same result for both ages
+            self.rule_cache[rule_str].age_independent = deps is not None and not any(
+                    isinstance(node, ast.Name) and node.id == 'age' for node in ast.walk(body))
         return self.rule_cache[rule_str]
 
 
+    def compile_rule(self, body, rule_str):
+        # requires consistent iteration on dicts
+        kwargs = [ast.arg(arg=k) for k in kwarg_defaults.keys()]
+        kwd = list(map(ast.Constant, kwarg_defaults.values()))
+        name = f'<{self.current_spot and self.current_spot.name}: {rule_str}>'
+        try:
+            return eval(compile(
+                ast.fix_missing_locations(
+                    ast.Expression(ast.Lambda(
+                        args=ast.arguments(
+                            posonlyargs=[],
+                            args=[ast.arg(arg='state')],
+                            defaults=[],
+                            kwonlyargs=kwargs,
+                            kw_defaults=kwd),
+                        body=body))),
+                name, 'eval'),
+                # globals/locals. if undefined, everything in the namespace *now* would be allowed
+                # Intentionally modifiable so we can add the ItemInfo solver ids as we go
+                allowed_globals)
+        except TypeError as e:
+            raise Exception('Parse Error: %s' % e, self.current_spot.name, ast.dump(body, False))
+
+
     ## Handlers for specific internal functions used in the json logic.
 
     # at(region_name, rule)
@@ -461,24 +673,24 @@ class Rule_AST_Transformer(ast.NodeTransformer):
     ## Handlers for compile-time optimizations (former State functions)
 
     def at_day(self, node):
-        if self.world.ensure_tod_access:
+        if self.world_value('ensure_tod_access'):
             # tod has DAY or (tod == NONE and (ss or find a path from a provider))
             # parsing is better than constructing this expression by hand
             return ast.parse("(tod & TimeOfDay.DAY) if tod else (state.has_all_of((Ocarina, Suns_Song)) or state.search.can_reach(spot.parent_region, age=age, tod=TimeOfDay.DAY))", mode='eval').body
         return ast.NameConstant(True)
 
     def at_dampe_time(self, node):
-        if self.world.ensure_tod_access:
+        if self.world_value('ensure_tod_access'):
             # tod has DAMPE or (tod == NONE and (find a path from a provider))
             # parsing is better than constructing this expression by hand
             return ast.parse("(tod & TimeOfDay.DAMPE) if tod else state.search.can_reach(spot.parent_region, age=age, tod=TimeOfDay.DAMPE)", mode='eval').body
         return ast.NameConstant(True)
 
     def at_night(self, node):
-        if self.current_spot.type == 'GS Token' and self.world.settings.logic_no_night_tokens_without_suns_song:
+        if self.current_spot.type == 'GS Token' and self.setting_value('logic_no_night_tokens_without_suns_song'):
             # Using visit here to resolve 'can_play' rule
             return self.visit(ast.parse('can_play(Suns_Song)', mode='eval').body)
-        if self.world.ensure_tod_access:
+        if self.world_value('ensure_tod_access'):
             # tod has DAMPE or (tod == NONE and (ss or find a path from a provider))
             # parsing is better than constructing this expression by hand
             return ast.parse("(tod & TimeOfDay.DAMPE) if tod else (state.has_all_of((Ocarina, Suns_Song)) or state.search.can_reach(spot.parent_region, age=age, tod=TimeOfDay.DAMPE))", mode='eval').body
@@ -492,11 +704,163 @@ class Rule_AST_Transformer(ast.NodeTransformer):
         return self.make_access_rule(self.visit(ast.parse(rule_string, mode='eval').body))
 
     def parse_spot_rule(self, spot):
-        rule = spot.rule_string.split('#', 1)[0].strip()
+        # Replaying a cached file
+        if self.cached_rules is not None:
+            rule_str = next(self.cached_rules)
+            self.current_spot = spot
+            access_rule = self.make_access_rule(self.cache_entry['bodies'][rule_str], rule_str,
+                                                self.cached_functions.get(rule_str))
+        # Recording a file for the cache
+        elif self.cache_entry is not None:
+            self.current_spot = spot
+            body = self.visit(ast.parse(spot.rule_string.split('#', 1)[0].strip(), mode='eval').body)
+            rule_str = ast.dump(body, False)
+            self.cache_entry['rules'].append(rule_str)
+            if rule_str not in self.cache_entry['bodies']:
+                self.cache_entry['bodies'][rule_str] = body
+                self.cache_entry['functions'][rule_str] = spot.name
+            access_rule = self.make_access_rule(body, rule_str)
+        else:
+            rule = spot.rule_string.split('#', 1)[0].strip()
+            access_rule = self.parse_rule(rule, spot)
 
-        access_rule = self.parse_rule(rule, spot)
         spot.set_rule(access_rule)
         if access_rule is self.rule_cache.get('NameConstant(False)') or access_rule is self.rule_cache.get('Constant(False)'):
             spot.never = True
         elif access_rule is self.rule_cache.get('NameConstant(True)') or access_rule is self.rule_cache.get('Constant(True)'):
             spot.always = True
+
+
+    # Called before parsing the spot rules of a logic file. If the settings
+    # have a rule_cache_dir, the transformed rules are loaded from there when
+    # this file was parsed before with the same folded values, or recorded
+    # to be saved by end_file otherwise.
+    # The cache keeps, for each file, which values its rules have folded so far:
+    # if they are all the same, the transformer folds the same values again.
+    def start_file(self, file_path):
+        cache_dir = self.world.settings.rule_cache_dir
+        if cache_dir:
+            try:
+                self.cache_file_hash = rule_file_hash(self.world, file_path, self.loaded_files)
+            except OSError as e:
+                logging.getLogger('').warning('Could not use the rule cache: %s', e)
+                cache_dir = None
+        if cache_dir:
+            try:
+                with open(os.path.join(cache_dir, self.cache_file_hash + '.values'), 'rb') as f:
+                    folded_values = pickle.load(f)
+                self.cache_key = self.rule_cache_key(folded_values)
+                with open(os.path.join(cache_dir, self.cache_key), 'rb') as f:
+                    self.cache_entry = pickle.load(f)
+            except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+                self.cache_entry = None
+            if self.cache_entry is not None:
+                self.all_folded_values.update(folded_values)
+                self.replay_cache_entry()
+            else:
+                self.cache_entry = {
+                    'rules': [],
+                    'bodies': {},
+                    # function names in the generated module, from the first spot with the rule
+                    'functions': {},
+                    # state of the transformer when the file started
+                    'events': self.events,
+                    'delayed_rules': len(self.delayed_rules),
+                    'replaced_rules': {target: len(rules) for target, rules in self.replaced_rules.items()},
+                }
+                self.events = set()
+                self.folded_values = set()
+        self.loaded_files.append(file_path)
+
+
+    # Saves the rules recorded since start_file, with the side effects
+    # parsing them had on the transformer.
+    def end_file(self):
+        entry = self.cache_entry
+        folded_values = self.folded_values
+        self.cache_entry = None
+        self.cached_rules = None
+        self.cached_functions = None
+        self.folded_values = None
+        if folded_values is None:
+            return
+        events = self.events
+        self.events = entry['events'] | events
+        entry['events'] = events
+        entry['delayed_rules'] = self.delayed_rules[entry['delayed_rules']:]
+        entry['replaced_rules'] = [
+            (target, rule, item_rule)
+            for target, rules in self.replaced_rules.items()
+            for rule, item_rule in list(rules.items())[entry['replaced_rules'].get(target, 0):]]
+        solver_ids = rule_solver_ids(entry['bodies'].values())
+        # The subrules of replaced rules also get their ids while parsing
+        solver_ids.update(ItemInfo.solver_ids[escape_name(subrule_name)] for _, _, subrule_name in entry['delayed_rules'])
+        entry['solver_ids'] = {name: solver_id for name, solver_id in ItemInfo.solver_ids.items() if solver_id in solver_ids}
+
+        cache_dir = self.world.settings.rule_cache_dir
+        values_path = os.path.join(cache_dir, self.cache_file_hash + '.values')
+        try:
+            with open(values_path, 'rb') as f:
+                folded_values.update(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        folded_values = sorted(folded_values)
+        key = self.rule_cache_key(folded_values)
+        functions = {}
+        for rule_str, spot_name in entry['functions'].items():
+            name = 'rule_' + re.sub(r'\W', '_', spot_name)
+            while name in functions.values():
+                name += '_'
+            functions[rule_str] = name
+        entry['functions'] = functions
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to temporary files first so concurrent generations never read half a file
+            files = [(os.path.join(cache_dir, key), entry), (values_path, folded_values)]
+            if hasattr(ast, 'unparse'):
+                files.append((os.path.join(cache_dir, f'rules_{key}.py'),
+                              rules_module_source((name, entry['bodies'][rule_str]) for rule_str, name in functions.items())))
+            for path, data in files:
+                if isinstance(data, str):
+                    with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+                        f.write(data)
+                else:
+                    with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
+                        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(f'{path}.{os.getpid()}.tmp', path)
+        except OSError as e:
+            logging.getLogger('').warning('Could not write to the rule cache: %s', e)
+
+
+    # Applies the side effects the cached rules had on the transformer
+    # when they were parsed, and prepares them for parse_spot_rule.
+    def replay_cache_entry(self):
+        entry = self.cache_entry
+        # Register the events in the order they were seen, which usually gives them the same ids as before
+        remap = {}
+        for name, solver_id in sorted(entry['solver_ids'].items(), key=lambda item: item[1]):
+            if name not in ItemInfo.solver_ids:
+                Item(name, event=True)
+            remap[solver_id] = ItemInfo.solver_ids[name]
+        self.cached_functions = {}
+        if all(old == new for old, new in remap.items()):
+            # The generated functions are only valid with the same solver ids
+            try:
+                module = import_rules_module(os.path.join(self.world.settings.rule_cache_dir, f'rules_{self.cache_key}.py'))
+                self.cached_functions = {rule_str: getattr(module, name) for rule_str, name in entry['functions'].items()}
+            except (OSError, SyntaxError, AttributeError) as e:
+                logging.getLogger('').debug('Could not import generated rules: %s', e)
+        else:
+            remapper = Mask_Remapper(remap)
+            bodies = {}
+            for rule_str, body in entry['bodies'].items():
+                body = remapper.visit(body)
+                bodies[rule_str] = (ast.dump(body, False), body)
+            entry['rules'] = [bodies[rule_str][0] for rule_str in entry['rules']]
+            entry['bodies'] = dict(bodies.values())
+
+        self.events |= entry['events']
+        self.delayed_rules.extend(entry['delayed_rules'])
+        for target, rule, item_rule in entry['replaced_rules']:
+            self.replaced_rules[target][rule] = item_rule
+        self.cached_rules = iter(entry['rules'])
@@ -3,13 +3,20 @@ from collections import defaultdict
 import itertools
 
 from LocationList import location_groups
+import Profiler
 from Region import TimeOfDay
 from State import State
 
 class Search(object):
 
-    def __init__(self, state_list, initial_cache=None):
+    # A search that isn't explored is left at its root regions, to be replayed (see replay).
+    def __init__(self, state_list, initial_cache=None, explore=True):
         self.state_list = [state.copy() for state in state_list]
+        # Log of every item count changed in our states, as solver id << 8 | world id,
+        # used to only re-evaluate the rules that read them.
+        self.item_changes = []
+        # Order the regions and locations were reached in, if recorded (see start_trail)
+        self.trail = None
 
         # Let the states reference this search.
         for state in self.state_list:
@@ -20,27 +27,64 @@ class Search(object):
             self.cached_spheres = [self._cache]
         else:
             root_regions = [state.world.get_region('Root') for state in self.state_list]
-            # The cache is a dict with 5 values:
+            # The cache is a dict with 8 values:
             #  child_regions, adult_regions: maps of Region -> tod, all the regions in that sphere
             #    values are lazily-determined tod flags (see TimeOfDay).
             #  child_queue, adult_queue: queue of Entrance, all the exits to try next sphere
             #  visited_locations: set of Locations visited in or before that sphere.
+            #  change_pos: position in item_changes the queues were last evaluated at,
+            #    or None if they have to be evaluated again regardless.
+            #  tod_done: map of (age, world id, tod) -> (position in item_changes, region count)
+            #    the tod was last spread as far as it goes at, in this sphere.
+            #  owned: names of the above containers that aren't shared with another cache.
+            #    The others have to be copied before changing them (see _own). The queues
+            #    are only ever replaced, so they never are.
             self._cache = {
                 'child_queue': list(exit for region in root_regions for exit in region.exits),
                 'adult_queue': list(exit for region in root_regions for exit in region.exits),
                 'visited_locations': set(),
                 'child_regions': {region: TimeOfDay.NONE for region in root_regions},
                 'adult_regions': {region: TimeOfDay.NONE for region in root_regions},
+                'change_pos': None,
+                'tod_done': {},
+                'owned': {'visited_locations', 'child_regions', 'adult_regions', 'tod_done'},
             }
             self.cached_spheres = [self._cache]
-            self.next_sphere()
+            if explore:
+                self.next_sphere()
 
 
     def copy(self):
         # we only need to copy the top sphere since that's what we're starting with and we don't go back
-        new_cache = {k: copy.copy(v) for k,v in self._cache.items()}
+        new_cache = self._share_cache()
         # copy always makes a nonreversible instance
-        return Search(self.state_list, initial_cache=new_cache)
+        new_search = Search(self.state_list, initial_cache=new_cache)
+        Profiler.count('search copies')
+        # The positions are in the old search's item_changes
+        if new_cache['change_pos'] is not None:
+            new_cache['change_pos'] = 0 if new_cache['change_pos'] == len(self.item_changes) else None
+        new_cache['tod_done'] = {}
+        new_cache['owned'].add('tod_done')
+        return new_search
+
+
+    # Returns a new cache sharing the containers of the current one,
+    # so copies only cost anything once either search changes them.
+    def _share_cache(self):
+        self._cache['owned'] = set()
+        new_cache = dict(self._cache)
+        new_cache['owned'] = set()
+        return new_cache
+
+
+    # Returns the container of the current cache with the given name, copying it
+    # first if it may be shared, so it can be changed.
+    def _own(self, key):
+        owned = self._cache['owned']
+        if key not in owned:
+            self._cache[key] = copy.copy(self._cache[key])
+            owned.add(key)
+        return self._cache[key]
 
 
     def collect_all(self, itempool):
@@ -93,32 +137,72 @@ class Search(object):
         raise Exception('Unimplemented for Search. Perhaps you want RewindableSearch.')
 
 
-    # Internal to the iteration. Modifies the exit_queue, regions.
+    # Returns a bitmask of the solver ids changed in each world since the given
+    # position in item_changes, as a list by world id.
+    def _change_masks(self, pos):
+        masks = [0] * len(self.state_list)
+        for key in self.item_changes[pos:]:
+            masks[key & 0xff] |= 1 << (key >> 8)
+        return masks
+
+
+    # Internal to the iteration. Modifies the regions of the given age, but not
+    # the exit_queue, which may be shared with another cache.
     # Returns a queue of the exits whose access rule failed,
     # as a cache for the exits to try on the next iteration.
-    def _expand_regions(self, exit_queue, regions, age):
+    # If no item changed since the exits in the queue failed, only the ones
+    # whose rule reads more than items are evaluated again.
+    def _expand_regions(self, exit_queue, age, unchanged=False):
+        regions = self._cache[age + '_regions']
+        trail = self.trail
         failed = []
-        for exit in exit_queue:
+        evaluated = 0
+        if unchanged:
+            retry = []
+            for exit in exit_queue:
+                if getattr(exit.access_rule, 'deps', None) is None:
+                    retry.append(exit)
+                else:
+                    failed.append(exit)
+            exit_queue = retry
+        # Exits to try after the queue, in the order they were found
+        found = []
+        for exit in itertools.chain(exit_queue, found):
             if exit.connected_region and exit.connected_region not in regions:
                 # Evaluate the access rule directly, without tod
+                evaluated += 1
                 if exit.access_rule(self.state_list[exit.world.id], spot=exit, age=age):
+                    regions = self._own(age + '_regions')
                     # If it found a new tod, make sure we try other entrances again.
                     # Probably would take too long and not be worth it if we only grabbed the exits
                     # for the given world...
                     if exit.connected_region.provides_time and not regions[exit.world.get_region('Root')] & exit.connected_region.provides_time:
-                        exit_queue.extend(failed)
+                        found.extend(failed)
                         failed = []
                         regions[exit.world.get_region('Root')] |= exit.connected_region.provides_time
                     regions[exit.connected_region] = exit.connected_region.provides_time
-                    exit_queue.extend(exit.connected_region.exits)
+                    found.extend(exit.connected_region.exits)
+                    if trail is not None:
+                        trail.append((age, exit, exit.connected_region))
                 else:
                     failed.append(exit)
+        Profiler.count('exit rules evaluated', evaluated)
         return failed
 
 
-    def _expand_tod_regions(self, regions, goal_region, age, tod):
+    # The tod is spread to every region it reaches in the world at once,
+    # so later queries in the same sphere with the same items are answered
+    # by the regions map directly.
+    def _expand_tod_regions(self, goal_region, age, tod):
+        regions = self._cache[age + '_regions']
+        key = (age, goal_region.world.id, tod)
+        tod_done = self._cache['tod_done']
+        stamp = (len(self.item_changes), len(regions))
+        if tod_done.get(key) == stamp:
+            # Already spread as far as it goes, and the goal wasn't reached
+            return False
         # grab all the exits from the regions with the given tod in the same world as our goal.
-        # we want those that go to existing regions without the tod, until we reach the goal.
+        # we want those that go to existing regions without the tod.
         has_tod_world = lambda regtod: regtod[1] & tod and regtod[0].world == goal_region.world
         exit_queue = list(itertools.chain.from_iterable(region.exits for region, _ in filter(has_tod_world, regions.items())))
         for exit in exit_queue:
@@ -126,11 +210,11 @@ class Search(object):
             if exit.connected_region in regions and tod & ~regions[exit.connected_region]:
                 # Evaluate the access rule directly
                 if exit.access_rule(self.state_list[exit.world.id], spot=exit, age=age, tod=tod):
+                    regions = self._own(age + '_regions')
                     regions[exit.connected_region] |= tod
-                    if exit.connected_region == goal_region:
-                        return True
                     exit_queue.extend(exit.connected_region.exits)
-        return False
+        self._own('tod_done')[key] = stamp
+        return bool(regions[goal_region] & tod)
 
 
     # Explores available exits, updating relevant entries in the cache in-place.
@@ -142,14 +226,16 @@ class Search(object):
 
         # Use the queue to iteratively add regions to the accessed set,
         # until we are stuck or out of regions.
+        Profiler.count('spheres')
+        unchanged = self._cache['change_pos'] == len(self.item_changes)
         self._cache.update({
-            # Replace the queues (which have been modified) with just the
-            # failed exits that we can retry next time.
-            'adult_queue': self._expand_regions(
-                self._cache['adult_queue'], self._cache['adult_regions'], 'adult'),
-            'child_queue': self._expand_regions(
-                self._cache['child_queue'], self._cache['child_regions'], 'child'),
+            # Replace the queues with just the failed exits that we can retry next time.
+            'adult_queue': self._expand_regions(self._cache['adult_queue'], 'adult', unchanged),
+            'child_queue': self._expand_regions(self._cache['child_queue'], 'child', unchanged),
+            'change_pos': len(self.item_changes),
+            'tod_done': {},
         })
+        self._cache['owned'].add('tod_done')
         return self._cache['child_regions'], self._cache['adult_regions'], self._cache['visited_locations']
 
     # Yields every reachable location, by iteratively deepening explored sets of
@@ -160,32 +246,98 @@ class Search(object):
     # Inside the loop, the caller usually wants to collect items at these
     # locations to see if the game is beatable. Collection should be done
     # using internal State (recommended to just call search.collect).
+    #
+    # After the first pass, a location is only checked again when its region
+    # is newly reached or an item its rule reads has changed. Locations are
+    # still checked in item_locations order, so this yields the same locations
+    # in the same order as checking every location on every pass.
     def iter_reachable_locations(self, item_locations):
+        # Indices of the locations in reached regions whose rule failed, in order
+        failing = []
+        # Locations waiting for their region to be reached (by either age)
+        by_region = defaultdict(list)
+        # Locations whose region was just reached, checked whatever changed
+        fresh = ()
+        # Solver ids changed in each world since the last pass started
+        masks = None
+        pass_pos = None
+        region_counts = None
+        # Counted for the profiler once the caller is done
+        checked = 0
+        item_changes = self.item_changes
         had_reachable_locations = True
-        # will loop as long as any visits were made, and at least once
-        while had_reachable_locations:
-            child_regions, adult_regions, visited_locations = self.next_sphere()
-
-            # Get all locations in accessible_regions that aren't visited,
-            # and check if they can be reached. Collect them.
-            had_reachable_locations = False
-            for loc in item_locations:
-                if loc in visited_locations:
-                    continue
-                # Check adult first; it's the most likely.
-                if (loc.parent_region in adult_regions
-                        and loc.access_rule(self.state_list[loc.world.id], spot=loc, age='adult')):
-                    had_reachable_locations = True
-                    # Mark it visited for this algorithm
-                    visited_locations.add(loc)
-                    yield loc
+        try:
+            # will loop as long as any visits were made, and at least once
+            while had_reachable_locations:
+                child_regions, adult_regions, visited_locations = self.next_sphere()
 
-                elif (loc.parent_region in child_regions
-                      and loc.access_rule(self.state_list[loc.world.id], spot=loc, age='child')):
+                if pass_pos is None:
+                    candidates = range(len(item_locations))
+                else:
+                    masks = self._change_masks(pass_pos)
+                    candidates = failing
+                    fresh = []
+                    # Regions are only ever added at the end of the dicts
+                    for regions, count in zip((child_regions, adult_regions), region_counts):
+                        for region in itertools.islice(regions, count, None):
+                            fresh.extend(by_region.pop(region, ()))
+                    if fresh:
+                        fresh = set(fresh)
+                        candidates = sorted(fresh.union(failing))
+                region_counts = (len(child_regions), len(adult_regions))
+                pass_pos = folded = len(item_changes)
+                failing = []
+
+                # Get all locations in accessible_regions that aren't visited,
+                # and check if they can be reached. Collect them.
+                had_reachable_locations = False
+                for i in candidates:
+                    loc = item_locations[i]
+                    if loc in visited_locations:
+                        continue
+                    rule = loc.access_rule
+                    first_check = masks is None or i in fresh
+                    if not first_check:
+                        # It was in a reached region, and still fails if none of the items its
+                        # rule reads changed since, counting the items collected so far in this pass
+                        deps = getattr(rule, 'deps', None)
+                        if deps is not None:
+                            if len(item_changes) > folded:
+                                for key in item_changes[folded:]:
+                                    masks[key & 0xff] |= 1 << (key >> 8)
+                                folded = len(item_changes)
+                            if not deps & masks[loc.world.id]:
+                                failing.append(i)
+                                continue
+                    in_adult = loc.parent_region in adult_regions
+                    in_child = loc.parent_region in child_regions
+                    if not (in_adult or in_child):
+                        by_region[loc.parent_region].append(i)
+                        continue
+                    checked += 1
+                    state = self.state_list[loc.world.id]
+                    # Check adult first; it's the most likely.
+                    if in_adult and rule(state, spot=loc, age='adult'):
+                        age = 'adult'
+                    # Rules that don't depend on age fail as child too
+                    elif (in_child and not (in_adult and getattr(rule, 'age_independent', False))
+                          and rule(state, spot=loc, age='child')):
+                        age = 'child'
+                    else:
+                        failing.append(i)
+                        if first_check and not (in_adult and in_child):
+                            by_region[loc.parent_region].append(i)
+                        continue
                     had_reachable_locations = True
-                    # Mark it visited for this algorithm
+                    # Mark it visited for this algorithm; a copy made while
+                    # yielding may share the set by now
+                    visited_locations = self._own('visited_locations')
                     visited_locations.add(loc)
+                    if self.trail is not None:
+                        self.trail.append((age, loc, None))
                     yield loc
+        finally:
+            Profiler.count('locations checked', checked)
 
 
     # This collects all item locations available in the state list given that
@@ -194,9 +346,102 @@ class Search(object):
     def collect_locations(self, item_locations=None):
         item_locations = item_locations or self.progression_locations()
         for location in self.iter_reachable_locations(item_locations):
+            if self.trail is not None:
+                self.trail.append((None, location, location.item))
             # Collect the item for the state world it is for
             self.collect(location.item)
 
+    # Starts recording the order regions are reached and locations are visited in,
+    # as (age, exit, region reached) or (age, location, None), each location followed
+    # by (None, location, item) if its item was collected, so a later search from the
+    # same starting point can take over what still holds for it (see replay).
+    def start_trail(self):
+        self.trail = []
+        self.trail_states = [state.copy() for state in self.state_list]
+
+
+    # Takes over the regions and locations that other, a search from the same starting
+    # point that recorded a trail, reached and are still reachable with the items of this one.
+    # The trail is followed in order, so each step is checked against what was kept before it:
+    # a rule that only reads items we have as many of at that point still passes and isn't
+    # evaluated again, the others are. The exits into the regions that weren't kept are
+    # tried again right away, and those that failed for other are left to the next sphere,
+    # so collect_locations then finishes this search as if it had explored everything itself.
+    # changed_exits maps the exits connected elsewhere since other was explored to the
+    # region they led to then. Nothing other reached through them is kept, and they are
+    # tried again from wherever they are connected now.
+    def replay(self, other, changed_exits=None):
+        changed_exits = changed_exits or {}
+        self.start_trail()
+        cache = self._cache
+        regions_by_age = {'child': self._own('child_regions'), 'adult': self._own('adult_regions')}
+        visited_locations = self._own('visited_locations')
+        # Bitmask of the items each world has fewer of than other had at that point
+        fewer = [sum(1 << solver_id for solver_id, (count, other_count) in enumerate(zip(state.solv_items, other_state.solv_items))
+                     if count < other_count)
+                 for state, other_state in zip(self.state_list, other.trail_states)]
+        # States to collect the items we don't into, logging which solver ids they change
+        # the way a search does
+        other_changes = Search([])
+        other_states = [state.copy() for state in other.trail_states]
+        for state in other_states:
+            state.search = other_changes
+        dropped = {'child': [], 'adult': []}
+
+        keep = False
+        for age, spot, value in other.trail:
+            if age is None:
+                # The item of the location visited in the step before
+                if keep and spot.item is value:
+                    self.collect(value)
+                    self.trail.append((age, spot, value))
+                else:
+                    if keep:
+                        # It holds another item now, so it's left to be visited again
+                        visited_locations.discard(spot)
+                        self.trail.pop()
+                    other_states[value.world.id].collect(value)
+                    for key in other_changes.item_changes:
+                        fewer[key & 0xff] |= 1 << (key >> 8)
+                    other_changes.item_changes.clear()
+                continue
+            regions = regions_by_age[age]
+            if value is not None:
+                keep = spot not in changed_exits and value not in regions and spot.parent_region in regions
+            else:
+                keep = spot not in visited_locations and spot.parent_region in regions
+            if keep:
+                deps = getattr(spot.access_rule, 'deps', None)
+                keep = ((deps is not None and not deps & fewer[spot.world.id])
+                        or spot.access_rule(self.state_list[spot.world.id], spot=spot, age=age))
+            if value is not None:
+                region = value
+                if keep:
+                    if region.provides_time:
+                        root = spot.world.get_region('Root')
+                        if not regions[root] & region.provides_time:
+                            regions[root] |= region.provides_time
+                    regions[region] = region.provides_time
+                elif region not in regions:
+                    dropped[age].append(region)
+            elif keep:
+                visited_locations.add(spot)
+            if keep:
+                self.trail.append((age, spot, value))
+
+        cache['tod_done'] = {}
+        cache['owned'].add('tod_done')
+        for age, regions in regions_by_age.items():
+            queue = [exit for exit in other._cache[age + '_queue']
+                     if exit.parent_region in regions and exit.connected_region not in regions]
+            retry = [exit for region in dropped[age] for exit in region.entrances if exit.parent_region in regions]
+            retry.extend(exit for exit in changed_exits if exit.parent_region in regions)
+            queue.extend(self._expand_regions(list(dict.fromkeys(retry)), age))
+            cache[age + '_queue'] = list(dict.fromkeys(queue))
+        # The failed exits were evaluated with other's items
+        cache['change_pos'] = None
+
+
     # A shorthand way to iterate over locations without collecting items.
     def visit_locations(self, locations=None):
         locations = locations or self.progression_locations()
@@ -293,7 +538,7 @@ class Search(object):
             for location in state.world.distribution.skipped_locations:
                 # We need to use the locations in the current world
                 location = state.world.get_location(location.name)
-                self._cache['visited_locations'].add(location)
+                self._own('visited_locations').add(location)
                 yield location
 
 
@@ -306,12 +551,12 @@ class Search(object):
     def can_reach(self, region, age=None, tod=TimeOfDay.NONE):
         if age == 'adult':
             if tod:
-                return region in self._cache['adult_regions'] and (self._cache['adult_regions'][region] & tod or self._expand_tod_regions(self._cache['adult_regions'], region, age, tod))
+                return region in self._cache['adult_regions'] and (self._cache['adult_regions'][region] & tod or self._expand_tod_regions(region, age, tod))
             else:
                 return region in self._cache['adult_regions']
         elif age == 'child':
             if tod:
-                return region in self._cache['child_regions'] and (self._cache['child_regions'][region] & tod or self._expand_tod_regions(self._cache['child_regions'], region, age, tod))
+                return region in self._cache['child_regions'] and (self._cache['child_regions'][region] & tod or self._expand_tod_regions(region, age, tod))
             else:
                 return region in self._cache['child_regions']
         elif age == 'both':
@@ -357,6 +602,12 @@ class Search(object):
 
 class RewindableSearch(Search):
 
+    def __init__(self, state_list, initial_cache=None, explore=True):
+        super().__init__(state_list, initial_cache, explore)
+        # The sphere cache the last check of can_still_beat_game started from, and its search
+        self.last_beatable_check = None
+
+
     def unvisit(self, location):
         # A location being unvisited is either:
         # in the top two caches (if it's the first being unvisited for a sphere)
@@ -366,7 +617,7 @@ class RewindableSearch(Search):
         if location in self.cached_spheres[-2]['visited_locations']:
             self.cached_spheres.pop()
             self._cache = self.cached_spheres[-1]
-        self._cache['visited_locations'].discard(location)
+        self._own('visited_locations').discard(location)
 
 
     def reset(self):
@@ -377,7 +628,21 @@ class RewindableSearch(Search):
     # Adds a new layer to the sphere cache, as a copy of the previous.
     def checkpoint(self):
         # Save the current data into the cache.
-        self.cached_spheres.append({
-            k: copy.copy(v) for k, v in self._cache.items()
-        })
+        self.cached_spheres.append(self._share_cache())
         self._cache = self.cached_spheres[-1]
+
+
+    # Returns whether the game can be beaten from here, like can_beat_game.
+    # Between two checks from the same sphere, only items are taken out of the states
+    # or placed at locations, so each one takes over what the last one reached that
+    # still holds (see replay) instead of collecting everything again.
+    def can_still_beat_game(self):
+        search = self.copy()
+        last = self.last_beatable_check
+        if last is not None and last[0] is self._cache:
+            search.replay(last[1])
+        else:
+            search.start_trail()
+        search.collect_locations()
+        self.last_beatable_check = (self._cache, search)
+        return search.can_beat_game(scan_for_items=False)
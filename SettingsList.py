@@ -1972,6 +1972,11 @@ setting_infos = [
         }),
     Setting_Info('output_dir',        str, "Output Directory", "Directoryinput", False, {}),
     Setting_Info('output_file',       str, None, None, False, {}),
+    Setting_Info('rule_cache_dir',    str, None, None, False, {}),
+    Setting_Info('profile_generation', bool, None, None, False, {}, default=False),
+    Setting_Info('profile_memory',    bool, None, None, False, {}, default=False),
+    Setting_Info('profile_rules',     bool, None, None, False, {}, default=False),
+    Setting_Info('entrance_shuffle_workers', int, None, None, False, {}, default=0),
     Checkbutton(
         name           = 'show_seed_info',
         gui_text       = 'Show Seed Info on File Screen',
@@ -2025,6 +2030,8 @@ setting_infos = [
             'min' : 1,
         }
     ),
+    Setting_Info('count_workers',     int, None, None, False, {}, default=1),
+    Setting_Info('attempt_workers',   int, None, None, False, {}, default=1),
     Setting_Info('world_count',       int, "Player Count", "Numberinput", True, {},
         default        = 1,
         gui_params = {
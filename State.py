@@ -10,10 +10,24 @@ Triforce = ItemInfo.solver_ids['Triforce']
 Rutos_Letter = ItemInfo.solver_ids['Rutos_Letter']
 Piece_of_Heart = ItemInfo.solver_ids['Piece_of_Heart']
 
+
+# Packs the given solver ids into a bitmask of the form used by State.item_mask.
+def solver_mask(items):
+    mask = 0
+    for i in items:
+        mask |= 1 << i
+    return mask
+
+
+bottle_mask = solver_mask(ItemInfo.bottle_ids)
+
 class State(object):
 
     def __init__(self, parent):
         self.solv_items = [0] * len(ItemInfo.solver_ids)
+        # Bit i is set when solv_items[i] is nonzero, so groups of items
+        # can be checked with a single operation (see solver_mask).
+        self.item_mask = 0
         self.world = parent
         self.search = None
         self._won = self.won_triforce_hunt if self.world.settings.triforce_hunt else self.won_normal
@@ -23,8 +37,10 @@ class State(object):
         if not new_world:
             new_world = self.world
         new_state = State(new_world)
-        for i, val in enumerate(self.solv_items):
-            new_state.solv_items[i] = val
+        # Events may have been registered since this state was made,
+        # so the new list can be longer.
+        new_state.solv_items[:len(self.solv_items)] = self.solv_items
+        new_state.item_mask = self.item_mask
         return new_state
 
 
@@ -63,6 +79,14 @@ class State(object):
         return True
 
 
+    def has_any_of_mask(self, mask):
+        return self.item_mask & mask != 0
+
+
+    def has_all_of_mask(self, mask):
+        return self.item_mask & mask == mask
+
+
     def count_of(self, items):
         s = 0
         for i in items:
@@ -80,7 +104,7 @@ class State(object):
 
     def has_bottle(self, **kwargs):
         # Extra Ruto's Letter are automatically emptied
-        return self.has_any_of(ItemInfo.bottle_ids) or self.has(Rutos_Letter, 2)
+        return self.item_mask & bottle_mask != 0 or self.has(Rutos_Letter, 2)
 
 
     def has_hearts(self, count):
@@ -162,10 +186,13 @@ class State(object):
             if dungeon_name in ['Forest Temple', 'Fire Temple', 'Water Temple', 'Shadow Temple', 'Spirit Temple']:
                 bk = f'Boss Key ({dungeon_name})'
                 self.solv_items[ItemInfo.solver_ids[escape_name(bk)]] = 1
+                self.changed(ItemInfo.solver_ids[escape_name(bk)])
         if item.alias:
             self.solv_items[item.alias_id] += item.alias[1]
+            self.changed(item.alias_id)
         if item.advancement:
             self.solv_items[item.solver_id] += 1
+            self.changed(item.solver_id)
 
 
     # Be careful using this function. It will not uncollect any
@@ -176,12 +203,27 @@ class State(object):
             if dungeon_name in ['Forest Temple', 'Fire Temple', 'Water Temple', 'Shadow Temple', 'Spirit Temple']:
                 bk = f'Boss Key ({dungeon_name})'
                 self.solv_items[ItemInfo.solver_ids[escape_name(bk)]] = 0
+                self.changed(ItemInfo.solver_ids[escape_name(bk)])
         if item.alias and self.solv_items[item.alias_id] > 0:
             self.solv_items[item.alias_id] -= item.alias[1]
             if self.solv_items[item.alias_id] < 0:
                 self.solv_items[item.alias_id] = 0
+            self.changed(item.alias_id)
         if self.solv_items[item.solver_id] > 0:
             self.solv_items[item.solver_id] -= 1
+            self.changed(item.solver_id)
+
+
+    # Updates item_mask for the changed item count, and records it with
+    # the search using this state so it knows which rules need to be evaluated again.
+    # World ids fit in 8 bits (up to 255 worlds).
+    def changed(self, solver_id):
+        if self.solv_items[solver_id]:
+            self.item_mask |= 1 << solver_id
+        else:
+            self.item_mask &= ~(1 << solver_id)
+        if self.search is not None:
+            self.search.item_changes.append(solver_id << 8 | self.world.id)
 
 
     def region_has_shortcuts(self, region_name):
@@ -2,24 +2,31 @@
 # With python3.10, you can instead run pytest Unittest.py
 # See `python -m unittest -h` or `pytest -h` for more options.
 
+import ast
 from collections import Counter, defaultdict
+import copy
 import json
 import logging
 import os
 import random
 import re
+import tempfile
 import unittest
 
-from EntranceShuffle import EntranceShuffleError
-from Fill import ShuffleError
+import EntranceShuffle
+from EntranceShuffle import EntranceShuffleError, EntranceCompatibility, ValidationSearches, check_entrances_compatibility
+from Fill import FillError, LocationPool, ShuffleError, fill_restrictive
 from Hints import HintArea
 from Hints import HintArea, buildMiscItemHints
-from Item import ItemInfo
+from Item import ItemInfo, ItemFactory
 from ItemPool import remove_junk_items, remove_junk_ludicrous_items, ludicrous_items_base, ludicrous_items_extended, trade_items, ludicrous_exclusions
 from LocationList import location_is_viewable
-from Main import main, resolve_settings, build_world_graphs
+from Main import main, resolve_settings, build_world_graphs, place_items, dummy_window
 from Messages import Message
+from Search import Search, RewindableSearch
 from Settings import Settings, get_preset_files
+from Utils import data_path
+from World import World
 
 test_dir = os.path.join(os.path.dirname(__file__), 'tests')
 output_dir = os.path.join(test_dir, 'Output')
@@ -652,6 +659,304 @@ class TestEntranceRandomizer(unittest.TestCase):
             with self.assertRaises(EntranceShuffleError):
                 build_world_graphs(settings)
 
+    def test_validation_searches(self):
+        # Each validation search takes over what the last one reached through the exits
+        # that weren't connected elsewhere since, so it must find the same as exploring again.
+        settings = make_settings_for_test({}, seed='TESTTESTTEST', outfilename='validation-searches')
+        resolve_settings(settings)
+        worlds = build_world_graphs(settings)
+        itempool = [item for world in worlds for item in world.get_itempool_with_dungeon_items()]
+        exits = [exit for region in worlds[0].regions for exit in region.exits if exit.connected_region]
+        rng = random.Random('TESTTESTTEST')
+        searches = ValidationSearches(worlds)
+        for _ in range(10):
+            first, second = rng.sample(exits, 2)
+            first_region, second_region = first.disconnect(), second.disconnect()
+            first.connect(second_region)
+            if rng.random() < 0.8:
+                second.connect(first_region)
+            else:
+                exits.remove(second)
+
+            fresh = Search.max_explore([world.state for world in worlds], itempool)
+            for search, fresh in ((searches.max_explore(itempool), fresh),
+                                  (searches.time_travel(), Search.with_items([world.state for world in worlds], [ItemFactory('Time Travel', world=world) for world in worlds]))):
+                for age in ('child', 'adult'):
+                    self.assertEqual(set(search.reachable_regions(age)), set(fresh.reachable_regions(age)))
+                self.assertEqual(search._cache['visited_locations'], fresh._cache['visited_locations'])
+                self.assertEqual([state.solv_items for state in search.state_list], [state.solv_items for state in fresh.state_list])
+
+    def test_compatible_targets(self):
+        # The targets left for an entrance must be those check_entrances_compatibility
+        # lets it replace, given every entrance placed before it.
+        test = self
+        checks = []
+        class CheckedCompatibility(EntranceCompatibility):
+            def __init__(self, target_entrances, placed_entrances=()):
+                self.placed = []
+                super().__init__(target_entrances, placed_entrances)
+
+            def place(self, entrance):
+                self.placed.append((entrance, None))
+                super().place(entrance)
+
+            def compatible_targets(self, entrance, target_entrances):
+                compatible = super().compatible_targets(entrance, target_entrances)
+                expected = []
+                for target in target_entrances:
+                    if target.connected_region is None:
+                        continue
+                    try:
+                        check_entrances_compatibility(entrance, target, self.placed)
+                    except EntranceShuffleError:
+                        continue
+                    expected.append(target)
+                test.assertEqual(compatible, expected)
+                checks.append(len(target_entrances) - len(compatible))
+                return compatible
+
+        settings = load_settings('entrance3.sav', seed='TESTTESTTEST')
+        resolve_settings(settings)
+        EntranceShuffle.EntranceCompatibility = CheckedCompatibility
+        try:
+            build_world_graphs(settings)
+        finally:
+            EntranceShuffle.EntranceCompatibility = EntranceCompatibility
+        self.assertTrue(any(checks))
+
+
+class TestWorld(unittest.TestCase):
+    def test_copy_graph(self):
+        # A world whose graph is copied from another must have the same regions, exits,
+        # locations and rules, and changing either graph must leave the other as it was.
+        settings = make_settings_for_test({'world_count': 2}, seed='TESTTESTTEST', outfilename='copy-graph')
+        resolve_settings(settings)
+        world = World(0, copy.copy(settings))
+        world.load_graph()
+        clone = World(1, copy.copy(settings))
+        clone.copy_graph(world)
+
+        self.assertEqual([region.name for region in clone.regions], [region.name for region in world.regions])
+        self.assertEqual(clone.event_items, world.event_items)
+        self.assertEqual([dungeon.name for dungeon in clone.dungeons], [dungeon.name for dungeon in world.dungeons])
+        self.assertIs(clone.parser.world, clone)
+        for region, new_region in zip(world.regions, clone.regions):
+            self.assertIsNot(new_region, region)
+            self.assertIs(new_region.world, clone)
+            self.assertEqual(new_region.scene, region.scene)
+            self.assertEqual(new_region.hint_name, region.hint_name)
+            self.assertEqual([location.name for location in new_region.locations], [location.name for location in region.locations])
+            for location, new_location in zip(region.locations, new_region.locations):
+                self.assertIsNot(new_location, location)
+                self.assertIs(new_location.world, clone)
+                self.assertIs(new_location.parent_region, new_region)
+                self.assertIs(new_location.access_rule, location.access_rule)
+                self.assertEqual(new_location.access_rules, location.access_rules)
+                if location.item is not None:
+                    self.assertEqual(new_location.item.name, location.item.name)
+                    self.assertIs(new_location.item.world, clone)
+                    self.assertIs(new_location.item.location, new_location)
+            self.assertEqual([exit.name for exit in new_region.exits], [exit.name for exit in region.exits])
+            for exit, new_exit in zip(region.exits, new_region.exits):
+                self.assertIsNot(new_exit, exit)
+                self.assertIs(new_exit.world, clone)
+                self.assertIs(new_exit.parent_region, new_region)
+                self.assertEqual(new_exit.connected_region, exit.connected_region)
+                self.assertIs(new_exit.access_rule, exit.access_rule)
+                self.assertEqual(new_exit.access_rules, exit.access_rules)
+
+        rules = [list(location.access_rules) for location in world.get_locations()]
+        clone.initialize_entrances()
+        for location in clone.get_locations():
+            location.add_rule(lambda state, **kwargs: False)
+        clone.parser.events.add('Test Event')
+        self.assertEqual([location.access_rules for location in world.get_locations()], rules)
+        for region in world.regions:
+            self.assertEqual(region.entrances, [])
+            for exit in region.exits:
+                self.assertIsInstance(exit.connected_region, str)
+        self.assertNotIn('Test Event', world.parser.events)
+
+
+class TestRuleParser(unittest.TestCase):
+    def test_rule_cache(self):
+        # Rules replayed from the rule cache must be the same as parsed ones
+        with tempfile.TemporaryDirectory() as cache_dir:
+            settings = make_settings_for_test({'rule_cache_dir': cache_dir}, seed='TESTTESTTEST', outfilename='rule-cache')
+            resolve_settings(settings)
+            worlds = []
+            cache_files = []
+            for _ in range(2):
+                world = World(0, settings)
+                world.load_regions_from_json(data_path(os.path.join('World', 'Overworld.json')))
+                worlds.append(world)
+                cache_files.append({name: os.stat(os.path.join(cache_dir, name)).st_mtime_ns for name in os.listdir(cache_dir)})
+            # The second world was loaded from the cache without writing to it
+            self.assertTrue(cache_files[0])
+            self.assertEqual(cache_files[0], cache_files[1])
+
+            # Compare the rules by their transformed AST
+            parsed, cached = ({
+                spot.name: ({id(rule): rule_str for rule_str, rule in world.parser.rule_cache.items()}[id(spot.access_rule)], spot.never, spot.always)
+                for region in world.regions for spot in region.locations + region.exits
+            } for world in worlds)
+            self.assertEqual(parsed, cached)
+            # The second world uses the generated rules module
+            self.assertFalse(any(rule.__name__ == '<lambda>' for rule in worlds[1].parser.rule_cache.values()))
+            parsed, cached = ([(target, ast.dump(node), name) for target, node, name in world.parser.delayed_rules] for world in worlds)
+            self.assertEqual(parsed, cached)
+
+
+class TestSearch(unittest.TestCase):
+    def test_incremental_search(self):
+        # A search collecting items as it goes skips the rules whose items didn't change,
+        # so it must still end up finding the same locations as a fresh search with those items.
+        settings = make_settings_for_test({}, seed='TESTTESTTEST', outfilename='incremental-search')
+        resolve_settings(settings)
+        worlds = build_world_graphs(settings)
+        locations = [location for world in worlds for location in world.get_locations()]
+        items = [item for world in worlds for item in world.itempool if item.advancement]
+        rng = random.Random('TESTTESTTEST')
+        for _ in range(5):
+            rng.shuffle(locations)
+            placement = dict(zip(locations, items))
+
+            search = Search([world.state for world in worlds])
+            found = set()
+            for location in search.iter_reachable_locations(locations):
+                found.add(location)
+                if location in placement:
+                    search.collect(placement[location])
+            fresh = Search(search.state_list)
+            self.assertEqual(found, set(fresh.iter_reachable_locations(locations)))
+
+    def test_replayed_search(self):
+        # As fill_restrictive takes items out of the assumed pool and places them, each max search
+        # takes over what the last one reached, so it must find the same as exploring again.
+        settings = make_settings_for_test({}, seed='TESTTESTTEST', outfilename='replayed-search')
+        resolve_settings(settings)
+        worlds = build_world_graphs(settings)
+        items = [item for world in worlds for item in world.itempool if item.advancement]
+        locations = [location for world in worlds for location in world.get_locations() if location.item is None]
+        random.Random('TESTTESTTEST').shuffle(locations)
+
+        items_search = Search([world.state for world in worlds])
+        items_search.collect_all(items)
+        max_search = None
+        for item, location in zip(items, locations):
+            items_search.uncollect(item)
+            last_max_search = max_search
+            max_search = items_search.copy()
+            if last_max_search is None:
+                max_search.start_trail()
+            else:
+                max_search.replay(last_max_search)
+            max_search.collect_locations()
+
+            fresh = items_search.copy()
+            fresh.collect_locations()
+            for age in ('child', 'adult'):
+                self.assertEqual(set(max_search.reachable_regions(age)), set(fresh.reachable_regions(age)))
+            self.assertEqual([l for l in locations if max_search.visited(l)], [l for l in locations if fresh.visited(l)])
+            self.assertEqual([state.solv_items for state in max_search.state_list], [state.solv_items for state in fresh.state_list])
+            location.item = item
+
+    def test_can_still_beat_game(self):
+        # As create_playthrough takes items away that aren't required, each check takes over
+        # what the last one reached, so it must find the same as exploring again.
+        settings = make_settings_for_test({}, seed='TESTTESTTEST', outfilename='can-still-beat-game')
+        resolve_settings(settings)
+        worlds = build_world_graphs(settings)
+        place_items(settings, worlds)
+        search = RewindableSearch([world.state for world in worlds])
+        locations = search.progression_locations()
+        random.Random('TESTTESTTEST').shuffle(locations)
+
+        for location in locations[:100]:
+            item = location.item
+            location.item = None
+            beatable = search.can_still_beat_game()
+            self.assertEqual(beatable, search.can_beat_game())
+            check = search.last_beatable_check[1]
+            fresh = search.copy()
+            fresh.collect_locations()
+            for age in ('child', 'adult'):
+                self.assertEqual(set(check.reachable_regions(age)), set(fresh.reachable_regions(age)))
+            self.assertEqual([state.solv_items for state in check.state_list], [state.solv_items for state in fresh.state_list])
+            if not beatable:
+                location.item = item
+
+
+class TestFill(unittest.TestCase):
+    def test_fill_fails_early(self):
+        # Items that can't all fit in the spots left for them make the fill fail before placing
+        # any of them, even with other locations left that they can't go in.
+        settings = make_settings_for_test({'shuffle_smallkeys': 'dungeon'}, seed='TESTTESTTEST', outfilename='fill-fails-early')
+        resolve_settings(settings)
+        worlds = build_world_graphs(settings)
+        keys = [item for item in worlds[0].get_restricted_dungeon_items() if item.name == 'Small Key (Forest Temple)']
+        dungeon_locations = [location for location in worlds[0].get_unfilled_locations() if HintArea.at(location) == HintArea.FOREST_TEMPLE]
+        other_locations = [location for location in worlds[0].get_unfilled_locations() if HintArea.at(location) != HintArea.FOREST_TEMPLE]
+        locations = dungeon_locations[:len(keys) - 1] + other_locations[:len(keys)]
+        search = Search([world.state for world in worlds])
+        search.collect_all(worlds[0].itempool)
+        window = dummy_window()
+        window.fillcount = 0
+        window.locationcount = len(locations)
+        self.assertGreater(len(keys), 1)
+        self.assertRaises(FillError, fill_restrictive, window, worlds, search, list(locations), list(keys))
+        self.assertTrue(all(location.item is None for location in locations))
+
+    def test_location_pool(self):
+        # Removing from the pool and picking at random from it must keep it holding exactly
+        # the locations not removed yet, each picked once per pass.
+        locations = ['Location %d' % i for i in range(20)]
+        pool = LocationPool(list(locations))
+        remaining = set(locations)
+        rng = random.Random('TESTTESTTEST')
+        random.seed('TESTTESTTEST')
+        while remaining:
+            self.assertEqual(len(pool), len(remaining))
+            self.assertEqual(set(pool), remaining)
+            picked = list(pool.shuffled())
+            self.assertEqual(sorted(picked), sorted(remaining))
+            # A pass that stops early leaves the pool as it was
+            for location in pool.shuffled():
+                break
+            self.assertEqual(set(pool), remaining)
+            removed = rng.choice(sorted(remaining))
+            pool.remove(removed)
+            remaining.remove(removed)
+            self.assertNotIn(removed, pool)
+            for location in remaining:
+                self.assertIn(location, pool)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(list(pool), [])
+        self.assertEqual(list(pool.shuffled()), [])
+
+    def test_fill_restricted_items(self):
+        # Dungeon items kept in their own dungeon must be placed there, however
+        # the locations they can go in are spread out in the pool.
+        settings = make_settings_for_test({'shuffle_smallkeys': 'dungeon', 'shuffle_bosskeys': 'dungeon', 'shuffle_ganon_bosskey': 'dungeon', 'shuffle_mapcompass': 'dungeon'},
+                                          seed='TESTTESTTEST', outfilename='fill-restricted-items')
+        resolve_settings(settings)
+        worlds = build_world_graphs(settings)
+        dungeon_items = [item for world in worlds for item in world.get_restricted_dungeon_items()]
+        locations = [location for world in worlds for location in world.get_unfilled_locations()]
+        random.shuffle(locations)
+        search = Search([world.state for world in worlds])
+        search.collect_all([item for world in worlds for item in world.itempool])
+        search.collect_locations()
+        window = dummy_window()
+        window.fillcount = 0
+        window.locationcount = len(locations)
+        fill_restrictive(window, worlds, search, locations, list(dungeon_items))
+        for item in dungeon_items:
+            self.assertIsNotNone(item.location)
+            self.assertTrue(HintArea.at(item.location.parent_region).is_dungeon_item(item))
+            self.assertNotIn(item.location, locations)
+        self.assertTrue(all(location.item is None for location in locations))
+
 
 class TestValidSpoilers(unittest.TestCase):
 
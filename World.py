@@ -1,9 +1,11 @@
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 import copy
 import logging
+import os
 import random
 import json
 
+from Dungeon import Dungeon, create_dungeons
 from Entrance import Entrance
 from Goals import Goal, GoalCategory
 from HintList import getRequiredHints, misc_item_hint_table, misc_location_hint_table
@@ -17,7 +19,13 @@ from Region import Region, TimeOfDay
 from RuleParser import Rule_AST_Transformer
 from SettingsList import get_setting_info, get_settings_from_section
 from State import State
-from Utils import read_logic_file
+from Utils import read_logic_file, data_path
+
+
+# Copies of the graphs load_graph has built in this process, most recent last,
+# as (graph_key, folded values with the values they had, copy).
+world_graph_snapshots = []
+max_world_graph_snapshots = 16
 
 class World(object):
 
@@ -30,6 +38,10 @@ class World(object):
         self._entrance_cache = {}
         self._region_cache = {}
         self._location_cache = {}
+        # Bumped whenever an entrance is connected or disconnected, so what's worked out
+        # from the world graph (like hint_area_cache, see HintArea.at) can tell it's stale.
+        self.graph_version = 0
+        self.hint_area_cache = {}
         self.required_locations = []
         self.shop_prices = {}
         self.scrub_prices = {}
@@ -533,9 +545,101 @@ class World(object):
         self.distribution.configure_randomized_settings(self)
 
 
+    # Loads the logic files with the dungeons and internal locations of this world.
+    # Nothing random happens in there, so the graph only depends on the settings:
+    # if one was built in this process for the same settings, it's copied instead.
+    def load_graph(self):
+        key = self.graph_key()
+        for snapshot_key, folded_values, snapshot in reversed(world_graph_snapshots):
+            if snapshot_key == key and all(
+                    (self if source == 'world' else self.settings).__dict__[name] == value
+                    for (source, name), value in folded_values.items()):
+                self.copy_graph(snapshot)
+                return
+
+        # Load common json rule files (those used regardless of MQ status)
+        if self.settings.logic_rules == 'glitched':
+            path = 'Glitched World'
+        else:
+            path = 'World'
+        path = data_path(path)
+
+        for filename in ('Overworld.json', 'Bosses.json'):
+            self.load_regions_from_json(os.path.join(path, filename))
+
+        # Compile the json rules based on settings
+        create_dungeons(self)
+        self.create_internal_locations()
+
+        folded_values = {
+            (source, name): copy.deepcopy((self if source == 'world' else self.settings).__dict__[name])
+            for source, name in self.parser.all_folded_values
+        }
+        snapshot = copy.copy(self)
+        snapshot.copy_graph(self)
+        world_graph_snapshots.append((key, folded_values, snapshot))
+        del world_graph_snapshots[:-max_world_graph_snapshots]
+
+
+    # What the graph depends on besides the values its rules fold,
+    # which rules can only read if they exist.
+    def graph_key(self):
+        return (
+            self.settings.logic_rules,
+            self.settings.profile_rules,
+            tuple(sorted(self.dungeon_mq.items())),
+            tuple(sorted(self.__dict__)),
+            tuple(sorted(self.settings.__dict__)),
+        )
+
+
+    # Replaces the graph of this world with a copy of the one load_graph built for another.
+    # Rules are shared, as they don't hold on to the world they were made for.
+    def copy_graph(self, other):
+        # Copies the attributes as they are, without the cost of going through copy.copy.
+        def clone(obj, **changes):
+            new_obj = object.__new__(obj.__class__)
+            new_obj.__dict__.update(obj.__dict__, **changes)
+            return new_obj
+
+        self.regions = []
+        for region in other.regions:
+            new_region = clone(region, world=self, entrances=[])
+            if region.dungeon:
+                new_region.dungeon = region.dungeon.name
+            new_region.locations = []
+            for location in region.locations:
+                new_location = clone(location, parent_region=new_region, world=self, access_rules=list(location.access_rules))
+                if location.item is not None:
+                    new_location.item = clone(location.item, world=self, location=new_location)
+                new_region.locations.append(new_location)
+            new_region.exits = [
+                clone(exit, parent_region=new_region, world=self, access_rules=list(exit.access_rules))
+                for exit in region.exits
+            ]
+            self.regions.append(new_region)
+        self.dungeons = [Dungeon(self, dungeon.name, dungeon.hint) for dungeon in other.dungeons]
+        self.event_items = set(other.event_items)
+        self._cached_locations = None
+        self._entrance_cache = {}
+        self._region_cache = {}
+        self._location_cache = {}
+
+        parser = copy.copy(other.parser)
+        parser.world = self
+        parser.events = set(parser.events)
+        parser.replaced_rules = defaultdict(dict, {target: dict(rules) for target, rules in parser.replaced_rules.items()})
+        parser.delayed_rules = list(parser.delayed_rules)
+        parser.rule_cache = dict(parser.rule_cache)
+        parser.loaded_files = list(parser.loaded_files)
+        parser.all_folded_values = set(parser.all_folded_values)
+        self.parser = parser
+
+
     def load_regions_from_json(self, file_path):
         region_json = read_logic_file(file_path)
 
+        self.parser.start_file(file_path)
         for region in region_json:
             new_region = Region(region['region_name'])
             new_region.world = self
@@ -589,6 +693,7 @@ class World(object):
                         self.parser.parse_spot_rule(new_exit)
                     new_region.exits.append(new_exit)
             self.regions.append(new_region)
+        self.parser.end_file()
 
 
     def create_internal_locations(self):